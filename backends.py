@@ -0,0 +1,392 @@
+# Backends de almacenamiento: Upstash Redis, SQLite local y memoria
+#
+# Todos exponen el mismo subconjunto de comandos tipo Redis que usa storage.py
+# (valores siempre como texto). Se elige con la variable STORAGE_BACKEND.
+import os
+import time
+import random
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Configuración del pool HTTP de Upstash
+UPSTASH_POOL_MAX = int(os.environ.get('UPSTASH_POOL_MAX', 20))
+UPSTASH_TIMEOUT_CONEXION = float(os.environ.get('UPSTASH_TIMEOUT_CONEXION', 3))
+UPSTASH_TIMEOUT_LECTURA = float(os.environ.get('UPSTASH_TIMEOUT_LECTURA', 10))
+UPSTASH_REINTENTOS = int(os.environ.get('UPSTASH_REINTENTOS', 2))
+
+# Latencia simulada por comando (ms) para pruebas de carga con backends locales
+LATENCIA_MS = float(os.environ.get('STORAGE_LATENCIA_MS', 0))
+LATENCIA_JITTER_MS = float(os.environ.get('STORAGE_LATENCIA_JITTER_MS', 0))
+
+
+class Backend(ABC):
+    """Interfaz común de los backends (subconjunto de comandos Redis); no se instancia si falta alguno"""
+    nombre = 'base'
+
+    @abstractmethod
+    def get(self, clave):
+        pass
+
+    @abstractmethod
+    def set(self, clave, valor):
+        pass
+
+    @abstractmethod
+    def mget(self, *claves):
+        pass
+
+    @abstractmethod
+    def mset(self, valores):
+        pass
+
+    @abstractmethod
+    def incr(self, clave):
+        pass
+
+    @abstractmethod
+    def expireat(self, clave, timestamp):
+        pass
+
+    @abstractmethod
+    def incr_expireat(self, clave, timestamp):
+        """INCR + EXPIREAT en una sola operación atómica; devuelve el nuevo valor"""
+
+    @abstractmethod
+    def delete(self, *claves):
+        pass
+
+
+class AdaptadorHTTP(HTTPAdapter):
+    """HTTPAdapter con timeout por defecto (upstash_redis no fija ninguno)"""
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class BackendUpstash(Backend):
+    """Upstash Redis por REST (producción, compartido entre réplicas)"""
+    nombre = 'upstash'
+
+    def __init__(self, url, token):
+        self.url = url
+        self.token = token
+        self.adaptador = None
+        self._cliente = None
+        self._lock = threading.Lock()
+
+    @property
+    def cliente(self):
+        """Cliente de upstash_redis, creado en el primer comando (no retrasa el arranque)"""
+        if self._cliente is None:
+            with self._lock:
+                if self._cliente is None:
+                    self._cliente = self._crear_cliente()
+        return self._cliente
+
+    def _crear_cliente(self):
+        from upstash_redis import Redis
+        # Los reintentos los hace el adaptador (solo fallos de conexión, con backoff):
+        # reenviar un INCR que sí llegó al servidor duplicaría el incremento
+        cliente = Redis(url=self.url, token=self.token, rest_retries=0)
+        self.adaptador = AdaptadorHTTP(
+            timeout=(UPSTASH_TIMEOUT_CONEXION, UPSTASH_TIMEOUT_LECTURA),
+            pool_connections=1,
+            pool_maxsize=UPSTASH_POOL_MAX,
+            max_retries=Retry(total=UPSTASH_REINTENTOS, connect=UPSTASH_REINTENTOS, read=0,
+                              status=0, backoff_factor=0.2),
+        )
+        cliente._session.mount('https://', self.adaptador)
+        cliente._session.mount('http://', self.adaptador)
+        return cliente
+
+    def estadisticas_conexiones(self):
+        """Peticiones HTTP hechas y conexiones (handshakes TLS) abiertas por el pool"""
+        peticiones = 0
+        conexiones = 0
+        pools = self.adaptador.poolmanager.pools if self.adaptador else {}
+        for clave in list(pools.keys()):
+            pool = pools.get(clave)
+            if pool is not None:
+                peticiones += pool.num_requests
+                conexiones += pool.num_connections
+        return {
+            'peticiones': peticiones,
+            'conexiones_nuevas': conexiones,
+            'reutilizadas': peticiones - conexiones,
+            'pool_max': UPSTASH_POOL_MAX,
+        }
+
+    def get(self, clave):
+        return self.cliente.get(clave)
+
+    def set(self, clave, valor):
+        return self.cliente.set(clave, valor)
+
+    def mget(self, *claves):
+        return self.cliente.mget(*claves)
+
+    def mset(self, valores):
+        return self.cliente.mset(valores)
+
+    def incr(self, clave):
+        return self.cliente.incr(clave)
+
+    def expireat(self, clave, timestamp):
+        return self.cliente.expireat(clave, timestamp)
+
+    def incr_expireat(self, clave, timestamp):
+        # upstash_redis 1.0 no trae transacciones: se llama a /multi-exec de la API REST
+        from upstash_redis.errors import UpstashError
+        respuesta = self.cliente._session.post(
+            f"{self.url.rstrip('/')}/multi-exec",
+            headers={'Authorization': f"Bearer {self.token}"},
+            json=[['INCR', clave], ['EXPIREAT', clave, int(timestamp)]],
+        ).json()
+        if isinstance(respuesta, dict):
+            raise UpstashError(respuesta.get('error', respuesta))
+        for parte in respuesta:
+            if parte.get('error'):
+                raise UpstashError(parte['error'])
+        return int(respuesta[0]['result'])
+
+    def delete(self, *claves):
+        return self.cliente.delete(*claves)
+
+
+class BackendMemoria(Backend):
+    """Diccionario en memoria (tests y benchmarks; se pierde al reiniciar)"""
+    nombre = 'memoria'
+
+    def __init__(self):
+        self.datos = {}
+        self.expiraciones = {}
+        self.lock = threading.Lock()
+
+    def _vivo(self, clave):
+        expira = self.expiraciones.get(clave)
+        if expira is not None and expira <= time.time():
+            self.datos.pop(clave, None)
+            self.expiraciones.pop(clave, None)
+        return clave in self.datos
+
+    def get(self, clave):
+        with self.lock:
+            return self.datos[clave] if self._vivo(clave) else None
+
+    def set(self, clave, valor):
+        with self.lock:
+            self.datos[clave] = valor
+            self.expiraciones.pop(clave, None)
+        return 'OK'
+
+    def mget(self, *claves):
+        with self.lock:
+            return [self.datos[c] if self._vivo(c) else None for c in claves]
+
+    def mset(self, valores):
+        with self.lock:
+            for clave, valor in valores.items():
+                self.datos[clave] = valor
+                self.expiraciones.pop(clave, None)
+        return True
+
+    def incr(self, clave):
+        with self.lock:
+            valor = int(self.datos[clave]) + 1 if self._vivo(clave) else 1
+            self.datos[clave] = str(valor)
+            return valor
+
+    def expireat(self, clave, timestamp):
+        with self.lock:
+            if not self._vivo(clave):
+                return 0
+            self.expiraciones[clave] = timestamp
+            return 1
+
+    def incr_expireat(self, clave, timestamp):
+        with self.lock:
+            valor = int(self.datos[clave]) + 1 if self._vivo(clave) else 1
+            self.datos[clave] = str(valor)
+            self.expiraciones[clave] = timestamp
+            return valor
+
+    def delete(self, *claves):
+        with self.lock:
+            borradas = 0
+            for clave in claves:
+                if self._vivo(clave):
+                    borradas += 1
+                self.datos.pop(clave, None)
+                self.expiraciones.pop(clave, None)
+            return borradas
+
+
+class BackendSQLite(Backend):
+    """Fichero SQLite local (un solo nodo, lecturas en disco local sin red)"""
+    nombre = 'sqlite'
+
+    # Cada cuántos incrementos se borran las claves caducadas
+    PURGA_CADA = 1000
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.lock = threading.Lock()
+        self.conexion = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self.conexion.execute("PRAGMA journal_mode=WAL")
+        self.conexion.execute("PRAGMA synchronous=NORMAL")
+        self.conexion.execute(
+            "CREATE TABLE IF NOT EXISTS kv (clave TEXT PRIMARY KEY, valor TEXT NOT NULL, expira REAL)")
+        self.incrementos = 0
+
+    def _borrar_caducada(self, clave):
+        self.conexion.execute(
+            "DELETE FROM kv WHERE clave = ? AND expira IS NOT NULL AND expira <= ?", (clave, time.time()))
+
+    def get(self, clave):
+        with self.lock:
+            fila = self.conexion.execute(
+                "SELECT valor FROM kv WHERE clave = ? AND (expira IS NULL OR expira > ?)",
+                (clave, time.time())).fetchone()
+            return fila[0] if fila else None
+
+    def set(self, clave, valor):
+        with self.lock:
+            self.conexion.execute(
+                "INSERT OR REPLACE INTO kv (clave, valor, expira) VALUES (?, ?, NULL)", (clave, valor))
+        return 'OK'
+
+    def mget(self, *claves):
+        ahora = time.time()
+        resultado = {}
+        with self.lock:
+            # SQLite limita los parámetros por consulta: se consulta en tramos
+            for i in range(0, len(claves), 500):
+                tramo = claves[i:i + 500]
+                marcas = ','.join('?' * len(tramo))
+                filas = self.conexion.execute(
+                    f"SELECT clave, valor FROM kv WHERE clave IN ({marcas}) AND (expira IS NULL OR expira > ?)",
+                    (*tramo, ahora)).fetchall()
+                resultado.update(filas)
+        return [resultado.get(c) for c in claves]
+
+    def mset(self, valores):
+        with self.lock:
+            self.conexion.execute("BEGIN")
+            try:
+                self.conexion.executemany(
+                    "INSERT OR REPLACE INTO kv (clave, valor, expira) VALUES (?, ?, NULL)",
+                    list(valores.items()))
+                self.conexion.execute("COMMIT")
+            except Exception:
+                self.conexion.execute("ROLLBACK")
+                raise
+        return True
+
+    def incr(self, clave):
+        with self.lock:
+            self._borrar_caducada(clave)
+            self.conexion.execute(
+                "INSERT INTO kv (clave, valor, expira) VALUES (?, '1', NULL) "
+                "ON CONFLICT(clave) DO UPDATE SET valor = CAST(valor AS INTEGER) + 1", (clave,))
+            valor = int(self.conexion.execute("SELECT valor FROM kv WHERE clave = ?", (clave,)).fetchone()[0])
+            self.incrementos += 1
+            if self.incrementos % self.PURGA_CADA == 0:
+                self.conexion.execute("DELETE FROM kv WHERE expira IS NOT NULL AND expira <= ?", (time.time(),))
+            return valor
+
+    def expireat(self, clave, timestamp):
+        with self.lock:
+            self._borrar_caducada(clave)
+            cursor = self.conexion.execute("UPDATE kv SET expira = ? WHERE clave = ?", (timestamp, clave))
+            return cursor.rowcount
+
+    def incr_expireat(self, clave, timestamp):
+        with self.lock:
+            self._borrar_caducada(clave)
+            self.conexion.execute(
+                "INSERT INTO kv (clave, valor, expira) VALUES (?, '1', ?) "
+                "ON CONFLICT(clave) DO UPDATE SET valor = CAST(valor AS INTEGER) + 1, expira = excluded.expira",
+                (clave, timestamp))
+            return int(self.conexion.execute("SELECT valor FROM kv WHERE clave = ?", (clave,)).fetchone()[0])
+
+    def delete(self, *claves):
+        with self.lock:
+            borradas = 0
+            for clave in claves:
+                self._borrar_caducada(clave)
+                borradas += self.conexion.execute("DELETE FROM kv WHERE clave = ?", (clave,)).rowcount
+            return borradas
+
+
+class BackendConLatencia(Backend):
+    """Envuelve otro backend y espera antes de cada comando, como si hubiera red de por medio"""
+
+    def __init__(self, interno, latencia_ms, jitter_ms=0):
+        self.interno = interno
+        self.nombre = interno.nombre
+        self.latencia = latencia_ms / 1000
+        self.jitter = jitter_ms / 1000
+
+    def _esperar(self):
+        time.sleep(max(0, self.latencia + random.uniform(-self.jitter, self.jitter)))
+
+    def get(self, clave):
+        self._esperar()
+        return self.interno.get(clave)
+
+    def set(self, clave, valor):
+        self._esperar()
+        return self.interno.set(clave, valor)
+
+    def mget(self, *claves):
+        self._esperar()
+        return self.interno.mget(*claves)
+
+    def mset(self, valores):
+        self._esperar()
+        return self.interno.mset(valores)
+
+    def incr(self, clave):
+        self._esperar()
+        return self.interno.incr(clave)
+
+    def expireat(self, clave, timestamp):
+        self._esperar()
+        return self.interno.expireat(clave, timestamp)
+
+    def incr_expireat(self, clave, timestamp):
+        self._esperar()
+        return self.interno.incr_expireat(clave, timestamp)
+
+    def delete(self, *claves):
+        self._esperar()
+        return self.interno.delete(*claves)
+
+
+def crear_backend(nombre):
+    """Crea el backend indicado ('upstash', 'sqlite' o 'memoria') con su configuración del entorno"""
+    nombre = (nombre or '').lower()
+    if nombre == 'upstash':
+        url = os.environ.get('UPSTASH_REDIS_REST_URL')
+        token = os.environ.get('UPSTASH_REDIS_REST_TOKEN')
+        if not (url and token):
+            raise ValueError("Faltan UPSTASH_REDIS_REST_URL / UPSTASH_REDIS_REST_TOKEN")
+        return BackendUpstash(url, token)
+    if nombre == 'sqlite':
+        interno = BackendSQLite(os.environ.get('STORAGE_SQLITE_PATH', 'perla.db'))
+    elif nombre == 'memoria':
+        interno = BackendMemoria()
+    else:
+        raise ValueError(f"Backend de almacenamiento desconocido: {nombre}")
+    if LATENCIA_MS or LATENCIA_JITTER_MS:
+        return BackendConLatencia(interno, LATENCIA_MS, LATENCIA_JITTER_MS)
+    return interno
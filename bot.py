@@ -1,19 +1,26 @@
+import time
+INICIO_ARRANQUE = time.perf_counter()  # para informar del tiempo de arranque
 import telebot
 from telebot import types
 from datetime import datetime, timedelta
 import schedule
-import time
 import random
 import json
 import os
+import sys
+import signal
 import requests
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import threading
-from dias_internacionales import DIAS_INTERNACIONALES
-from horoscopo import obtener_horoscopo, listar_signos
-from contenido import PALABRAS_CURIOSAS, REFRANES, FRASES_AMIGOS, MITOS_DESMONTADOS, PERLAS_OSCURAS
-from efemerides import EFEMERIDES
+import hmac
+from urllib.parse import urlparse, parse_qs
+from horoscopo import listar_signos, normalizar_signo, predicciones_del_dia, SIGNOS
 import storage
+import catalogo
+import seleccion
+import plantillas
+import recarga
+import difusion
 import pytz
 
 # Timezone de España
@@ -23,15 +30,24 @@ def hora_spain():
     """Devuelve la hora actual en España"""
     return datetime.now(TIMEZONE_SPAIN)
 
+def fecha_spain():
+    """Fecha de hoy en España (YYYY-MM-DD): la del contexto diario, cuotas y puntos"""
+    return hora_spain().strftime("%Y-%m-%d")
+
 # Tu token del BotFather
 TOKEN = os.environ.get('TOKEN')
 bot = telebot.TeleBot(TOKEN)
 
+# API de Telegram (se puede apuntar a servidor_local.py para pruebas de carga sin red)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+telebot.apihelper.API_URL = TELEGRAM_API_URL + '/bot{0}/{1}'
+
 # Tu ID de chat
 CHAT_ID = os.environ.get('CHAT_ID')
 
 # Claves para Redis
 REDIS_ESTADO = 'estado_usado'
+REDIS_ESTADO_USUARIO = 'estado:'  # + user_id
 REDIS_SUGERENCIAS = 'sugerencias'
 REDIS_VOTOS = 'votos'
 REDIS_PUNTOS = 'puntos'
@@ -40,13 +56,30 @@ REDIS_FRASES_APROBADAS = 'frases_aprobadas'
 REDIS_REFRANES_APROBADOS = 'refranes_aprobados'
 REDIS_PALABRAS_APROBADAS = 'palabras_aprobadas'
 REDIS_MITOS_APROBADOS = 'mitos_aprobados'
+REDIS_VERSION_APROBADOS = 'version_aprobados'  # + ':' + clave de la lista de aprobados
 REDIS_USOS_AHORA = 'usos_ahora'
 REDIS_USOS_DESAFIO = 'usos_desafio'
 REDIS_MODO_OSCURO = 'modo_oscuro'
 REDIS_USOS_OSCURA = 'usos_oscura'
 REDIS_DESAFIO_USADAS = 'desafio_palabras_usadas'
+REDIS_MIGRACION_CUOTAS = 'migracion_cuotas'
 REDIS_QUEJAS = 'buzon_quejas'
 
+CLAVES_APROBADOS = [REDIS_PALABRAS_APROBADAS, REDIS_REFRANES_APROBADOS,
+                    REDIS_FRASES_APROBADAS, REDIS_MITOS_APROBADOS]
+
+def clave_version_aprobados(clave):
+    """Contador de versión de una lista de aprobados (sube con cada aprobación)"""
+    return f"{REDIS_VERSION_APROBADOS}:{clave}"
+
+# Claves que lee el mensaje diario (se precargan juntas en una sola petición). De los
+# aprobados solo se leen las versiones: las listas se sirven de memoria mientras no cambien
+CLAVES_MENSAJE_DIARIO = [REDIS_ESTADO] + [clave_version_aprobados(c) for c in CLAVES_APROBADOS]
+
+def precargar(*claves):
+    """Trae varias claves de Redis en una sola petición; las lecturas siguientes salen de la caché"""
+    storage.obtener_muchos(claves)
+
 # Diccionario para trackear usuarios escribiendo quejas
 USUARIOS_QUEJA = {}  # {user_id: {'chat_id': int}}
 
@@ -59,13 +92,71 @@ def guardar_quejas(quejas):
     storage.guardar_lista(REDIS_QUEJAS, quejas)
 
 def cargar_estado():
-    """Carga el estado de elementos ya usados"""
+    """Carga el estado global de elementos ya usados (mitos y envíos sin usuario)"""
     return storage.obtener_dict(REDIS_ESTADO) or {'palabras': [], 'refranes': [], 'frases': []}
 
 def guardar_estado(estado):
-    """Guarda el estado de elementos usados"""
+    """Guarda el estado global de elementos usados"""
     storage.guardar_dict(REDIS_ESTADO, estado)
 
+# Campos del estado global que no pertenecen a ningún usuario
+CAMPOS_ESTADO_GLOBAL = {'palabras', 'refranes', 'frases', 'mitos_usados', 'mito_fecha', 'mito_actual', 'cursor', 'bits'}
+ESTADO_MIGRADO = False
+_migracion_lock = threading.Lock()
+
+def clave_estado_usuario(user_id):
+    """Clave de Redis con el historial de un usuario"""
+    return f"{REDIS_ESTADO_USUARIO}{user_id}"
+
+def migrar_estado_por_usuario():
+    """Mueve el historial de cada usuario del blob estado_usado a su propia clave (una sola vez)"""
+    global ESTADO_MIGRADO
+    if ESTADO_MIGRADO:
+        return
+    with _migracion_lock:
+        if ESTADO_MIGRADO:
+            return
+        # cargar_estado() devuelve el estado vacío si Redis falla: se lee marcando los fallos
+        # para no dar la migración por hecha sin haber visto el blob (se reintenta en la próxima llamada)
+        estado = storage.obtener_muchos([REDIS_ESTADO], marcar_fallos=True)[REDIS_ESTADO]
+        if estado is storage.FALLO_LECTURA:
+            print("⚠️ No se pudo leer estado_usado, la migración se reintentará")
+            return
+        estado = estado or {}
+        por_usuario = {k: v for k, v in estado.items()
+                       if k not in CAMPOS_ESTADO_GLOBAL and isinstance(v, dict)}
+        if por_usuario:
+            claves = list(por_usuario)
+            for i in range(0, len(claves), 200):
+                lote = {clave_estado_usuario(k): por_usuario[k] for k in claves[i:i + 200]}
+                if not storage.guardar_muchos(lote):
+                    print("⚠️ Migración de estado_usado interrumpida, se reintentará")
+                    return
+            estado_global = {k: v for k, v in estado.items() if k not in por_usuario}
+            guardar_estado(estado_global)
+            print(f"✅ Estado migrado a claves por usuario: {len(por_usuario)} usuarios")
+        ESTADO_MIGRADO = True
+
+def cargar_estado_usuario(user_id):
+    """Carga el historial de contenido ya visto por un usuario"""
+    migrar_estado_por_usuario()
+    return storage.obtener_dict(clave_estado_usuario(user_id)) or {'palabras': [], 'refranes': [], 'frases': []}
+
+def guardar_estado_usuario(user_id, estado):
+    """Guarda el historial de contenido visto por un usuario"""
+    storage.guardar_dict(clave_estado_usuario(user_id), estado)
+
+def cargar_historial(user_id=None):
+    """Historial del usuario si se indica, o el estado global si no"""
+    return cargar_estado_usuario(user_id) if user_id else cargar_estado()
+
+def guardar_historial(estado, user_id=None):
+    """Guarda el historial del usuario si se indica, o el estado global si no"""
+    if user_id:
+        guardar_estado_usuario(user_id, estado)
+    else:
+        guardar_estado(estado)
+
 def cargar_sugerencias():
     """Carga las sugerencias guardadas"""
     return storage.obtener_lista(REDIS_SUGERENCIAS)
@@ -92,68 +183,86 @@ def guardar_sugerencias(sugerencias):
     """Guarda todas las sugerencias"""
     storage.guardar_lista(REDIS_SUGERENCIAS, sugerencias)
 
+# Listas de aprobados en memoria: {clave: (version, lista)}. Solo se vuelven a leer de Redis
+# cuando cambia su versión; la versión se lee con la caché de storage (STORAGE_CACHE_TTL),
+# así que una aprobación en otra réplica se ve aquí como mucho tras ese plazo
+_aprobados = {}
+_aprobados_lock = threading.Lock()
+
+def cargar_aprobados(clave):
+    """Lista de aprobados de una clave (compartida: no modificar)"""
+    version = storage.obtener(clave_version_aprobados(clave), 0)
+    guardada = _aprobados.get(clave)
+    if guardada is not None and guardada[0] == version:
+        return guardada[1]
+    # Versión nueva: la lista en la caché de storage puede ser anterior a la aprobación
+    storage.invalidar(clave)
+    lista = storage.obtener_lista(clave)
+    _aprobados[clave] = (version, lista)
+    return lista
+
+def guardar_aprobado(clave, item):
+    """Añade un elemento a una lista de aprobados y sube su versión (invalida las demás réplicas)"""
+    with _aprobados_lock:
+        storage.invalidar(clave)
+        lista = storage.obtener_lista(clave)
+        if item in lista:
+            return
+        lista.append(item)
+        storage.guardar_lista(clave, lista)
+        version = storage.incrementar(clave_version_aprobados(clave))
+        if version:
+            _aprobados[clave] = (version, lista)
+        else:
+            _aprobados.pop(clave, None)
+
 def cargar_frases_aprobadas():
     """Carga las frases aprobadas dinámicamente"""
-    return storage.obtener_lista(REDIS_FRASES_APROBADAS)
+    return cargar_aprobados(REDIS_FRASES_APROBADAS)
 
 def guardar_frase_aprobada(frase):
     """Añade una frase aprobada"""
-    frases = cargar_frases_aprobadas()
-    if frase not in frases:
-        frases.append(frase)
-        storage.guardar_lista(REDIS_FRASES_APROBADAS, frases)
+    guardar_aprobado(REDIS_FRASES_APROBADAS, frase)
 
 def cargar_refranes_aprobados():
     """Carga los refranes aprobados dinámicamente"""
-    return storage.obtener_lista(REDIS_REFRANES_APROBADOS)
+    return cargar_aprobados(REDIS_REFRANES_APROBADOS)
 
 def guardar_refran_aprobado(refran):
     """Añade un refrán aprobado"""
-    refranes = cargar_refranes_aprobados()
-    if refran not in refranes:
-        refranes.append(refran)
-        storage.guardar_lista(REDIS_REFRANES_APROBADOS, refranes)
+    guardar_aprobado(REDIS_REFRANES_APROBADOS, refran)
 
 def cargar_palabras_aprobadas():
     """Carga las palabras aprobadas dinámicamente"""
-    return storage.obtener_lista(REDIS_PALABRAS_APROBADAS)
+    return cargar_aprobados(REDIS_PALABRAS_APROBADAS)
 
 def guardar_palabra_aprobada(palabra):
     """Añade una palabra aprobada"""
-    palabras = cargar_palabras_aprobadas()
-    if palabra not in palabras:
-        palabras.append(palabra)
-        storage.guardar_lista(REDIS_PALABRAS_APROBADAS, palabras)
+    guardar_aprobado(REDIS_PALABRAS_APROBADAS, palabra)
 
 def cargar_mitos_aprobados():
     """Carga los mitos aprobados dinámicamente"""
-    return storage.obtener_lista(REDIS_MITOS_APROBADOS)
+    return cargar_aprobados(REDIS_MITOS_APROBADOS)
 
 def guardar_mito_aprobado(mito):
     """Añade un mito aprobado"""
-    mitos = cargar_mitos_aprobados()
-    if mito not in mitos:
-        mitos.append(mito)
-        storage.guardar_lista(REDIS_MITOS_APROBADOS, mitos)
+    guardar_aprobado(REDIS_MITOS_APROBADOS, mito)
 
 def obtener_todas_frases():
-    """Combina frases de contenido.py + aprobadas dinámicamente"""
-    return FRASES_AMIGOS + cargar_frases_aprobadas()
+    """Combina frases de contenido.py + aprobadas dinámicamente (catálogo ya procesado)"""
+    return catalogo.valores('frases', cargar_frases_aprobadas())
 
 def obtener_todos_refranes():
-    """Combina refranes de contenido.py + aprobados dinámicamente"""
-    return REFRANES + cargar_refranes_aprobados()
+    """Combina refranes de contenido.py + aprobados dinámicamente (catálogo ya procesado)"""
+    return catalogo.valores('refranes', cargar_refranes_aprobados())
 
 def obtener_todas_palabras():
-    """Combina palabras de contenido.py + aprobadas dinámicamente"""
-    return PALABRAS_CURIOSAS + cargar_palabras_aprobadas()
+    """Combina palabras de contenido.py + aprobadas dinámicamente (catálogo ya procesado)"""
+    return catalogo.valores('palabras', cargar_palabras_aprobadas())
 
 def obtener_todos_mitos():
-    """Combina mitos de contenido.py + aprobados dinámicamente"""
-    mitos_aprobados = cargar_mitos_aprobados()
-    # Filtrar solo los que tienen formato correcto (diccionario con 'mito' y 'realidad')
-    mitos_validos = [m for m in mitos_aprobados if isinstance(m, dict) and 'mito' in m and 'realidad' in m]
-    return MITOS_DESMONTADOS + mitos_validos
+    """Combina mitos de contenido.py + aprobados dinámicamente (solo los que tienen 'mito' y 'realidad')"""
+    return catalogo.valores('mitos', cargar_mitos_aprobados())
 
 def cargar_usuarios():
     """Carga el registro de usuarios"""
@@ -179,6 +288,23 @@ def registrar_usuario(user, chat_id=None):
     }
     guardar_usuarios(usuarios)
 
+def es_suscrito(data):
+    """True si el usuario recibe las difusiones (tiene chat_id y el chat sigue activo)"""
+    return bool(data.get('chat_id')) and data.get('activo', True)
+
+@difusion.al_desactivar
+def desactivar_usuarios(user_ids):
+    """Marca como inactivos los usuarios cuyo chat ya no acepta mensajes (bloqueo, cuenta borrada...).
+    Se reactivan solos al volver a hablar con el bot (registrar_usuario rehace la entrada)."""
+    usuarios = cargar_usuarios()
+    cambiados = [uid for uid in user_ids if uid in usuarios and usuarios[uid].get('activo', True)]
+    if not cambiados:
+        return
+    for uid in cambiados:
+        usuarios[uid]['activo'] = False
+    guardar_usuarios(usuarios)
+    print(f"🚫 {len(cambiados)} chats marcados como inactivos")
+
 def cargar_votos():
     """Carga los votos guardados"""
     return storage.obtener_dict(REDIS_VOTOS)
@@ -227,7 +353,7 @@ def sumar_puntos(user_id, nombre, puntos_ganados, username=None, intento=1):
     """Suma puntos al usuario con historial por fecha"""
     puntos = cargar_puntos()
     user_key = str(user_id)
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
+    fecha_hoy = fecha_spain()
     
     if user_key not in puntos:
         puntos[user_key] = {'nombre': nombre, 'username': username, 'historial': [], 'stats': {'jugados': 0, 'aciertos_1': 0, 'aciertos_2': 0, 'aciertos_3plus': 0}}
@@ -264,7 +390,8 @@ def calcular_puntos_semana(user_key, semana_anterior=False):
     if user_key not in puntos:
         return 0
     
-    hoy = datetime.now()
+    # Misma fecha de España con la que sumar_puntos guarda el historial (sin zona, para comparar)
+    hoy = hora_spain().replace(tzinfo=None)
     # Inicio de la semana actual (lunes a las 00:00)
     inicio_semana_actual = hoy - timedelta(days=hoy.weekday())
     inicio_semana_actual = inicio_semana_actual.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -293,7 +420,7 @@ def calcular_puntos_mes(user_key, mes_anterior=False):
     if user_key not in puntos:
         return 0
     
-    hoy = datetime.now()
+    hoy = hora_spain()
     
     if mes_anterior:
         # Mes anterior
@@ -332,22 +459,19 @@ def obtener_ranking(periodo='semana', semana_anterior=False, mes_anterior=False)
 
 def parsear_palabra(texto, incluir_etimologia=True):
     """Separa 'Palabra: definición (etimología)' en (palabra, definición)"""
-    if ':' in texto:
-        partes = texto.split(':', 1)
-        palabra = partes[0].strip()
-        definicion = partes[1].strip()
-        
-        # Quitar etimología (texto entre paréntesis al final) si no se quiere
-        if not incluir_etimologia and '(' in definicion:
-            definicion = definicion.rsplit('(', 1)[0].strip()
-        
-        return palabra, definicion
-    return texto, ""
+    elemento = catalogo.elemento_de(texto, 'palabras')
+    if elemento is not None:
+        palabra, definicion, etimologia = elemento.palabra, elemento.definicion, elemento.etimologia
+    else:
+        palabra, definicion, etimologia = catalogo.separar_palabra(texto)
+    if incluir_etimologia and etimologia:
+        return palabra, f"{definicion} {etimologia}"
+    return palabra, definicion
 
-def obtener_palabra_desafio_hoy():
+def obtener_palabra_desafio_hoy(fecha_hoy=None):
     """Obtiene la palabra del desafío de hoy, sin repetir hasta agotar todas"""
     import hashlib
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
+    fecha_hoy = fecha_hoy or datetime.now().strftime("%Y-%m-%d")
     
     # Cargar estado del desafío
     estado = storage.obtener_dict(REDIS_DESAFIO_USADAS) or {'fecha': '', 'palabra': '', 'usadas': []}
@@ -358,10 +482,11 @@ def obtener_palabra_desafio_hoy():
     
     # Nueva fecha: seleccionar palabra no usada
     todas_palabras = obtener_todas_palabras()
-    usadas = estado.get('usadas', [])
+    usadas = catalogo.normalizar_usados(estado.get('usadas', []))
     
     # Filtrar disponibles
-    disponibles = [p for p in todas_palabras if p not in usadas]
+    usadas_ids = set(usadas)
+    disponibles = [p for p in todas_palabras if catalogo.id_contenido(p) not in usadas_ids]
     
     # Si se agotaron, reiniciar
     if not disponibles:
@@ -374,7 +499,7 @@ def obtener_palabra_desafio_hoy():
     palabra_completa = rng.choice(disponibles)
     
     # Guardar estado
-    usadas.append(palabra_completa)
+    usadas.append(catalogo.id_contenido(palabra_completa))
     storage.guardar_dict(REDIS_DESAFIO_USADAS, {
         'fecha': fecha_hoy,
         'palabra': palabra_completa,
@@ -383,22 +508,22 @@ def obtener_palabra_desafio_hoy():
     
     return palabra_completa
 
-def generar_quiz():
+def generar_quiz(fecha_hoy=None):
     """Genera un quiz con una palabra y 4 opciones (mismo desafío para todos cada día)"""
     import hashlib
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
+    fecha_hoy = fecha_hoy or datetime.now().strftime("%Y-%m-%d")
     semilla = int(hashlib.md5(f"desafio_{fecha_hoy}".encode()).hexdigest(), 16) % (2**32)
     rng = random.Random(semilla)
     
     # Obtener palabra del día (sin repetir hasta agotar todas)
-    palabra_completa = obtener_palabra_desafio_hoy()
+    palabra_completa = obtener_palabra_desafio_hoy(fecha_hoy)
     palabra, definicion_correcta = parsear_palabra(palabra_completa, incluir_etimologia=False)
     
-    # Obtener 3 definiciones incorrectas (sin etimología para dificultar)
-    todas_palabras = obtener_todas_palabras()
-    otras = [p for p in todas_palabras if p != palabra_completa]
+    # Obtener 3 definiciones incorrectas (sin etimología para dificultar), ya separadas en el catálogo
+    elementos = catalogo.obtener_categoria('palabras', cargar_palabras_aprobadas()).elementos
+    otras = [e for e in elementos if e.valor != palabra_completa]
     incorrectas = rng.sample(otras, min(3, len(otras)))
-    opciones_incorrectas = [parsear_palabra(p, incluir_etimologia=False)[1] for p in incorrectas]
+    opciones_incorrectas = [e.definicion for e in incorrectas]
     
     # Mezclar opciones (con la misma semilla para consistencia)
     todas_opciones = [definicion_correcta] + opciones_incorrectas
@@ -407,43 +532,113 @@ def generar_quiz():
     
     return palabra, todas_opciones, indice_correcto
 
-def obtener_sin_repetir(lista, usados_key, user_id=None):
-    """Obtiene un elemento aleatorio sin repetir hasta agotar la lista (por usuario)"""
-    estado = cargar_estado()
-    
-    # Si hay user_id, usar historial por usuario
-    if user_id:
-        user_key = str(user_id)
-        if user_key not in estado:
-            estado[user_key] = {'palabras': [], 'refranes': [], 'frases': []}
-        usados = estado[user_key].get(usados_key, [])
-    else:
-        usados = estado.get(usados_key, [])
-    
-    disponibles = [item for item in lista if item not in usados]
+# Orden fijo de cada categoría para los modos cursor y bitset: lista de IDs. Solo se
+# añaden IDs al final, así que la posición (el bit) de un elemento no cambia aunque se
+# añada contenido en medio de contenido.py o se quite algo (su hueco queda sin usar)
+REDIS_ORDEN_SELECCION = 'orden_seleccion'  # + ':' + categoria
+_orden_seleccion = {}  # categoria -> (lista de la que se calculó, IDs, orden, máscara de ausentes)
+_orden_lock = threading.Lock()
+
+def orden_seleccion(lista, categoria):
+    """(orden, máscara): valores por posición estable (None si ya no existe) y máscara de huecos"""
+    guardado = _orden_seleccion.get(categoria)
+    if guardado is not None and guardado[0] is lista:
+        return guardado[2], guardado[3]
+    with _orden_lock:
+        guardado = _orden_seleccion.get(categoria)
+        if guardado is not None and guardado[0] is lista:
+            return guardado[2], guardado[3]
+        clave = f"{REDIS_ORDEN_SELECCION}:{categoria}"
+        previos = storage.obtener_muchos([clave], default=[], cachear=False, marcar_fallos=True)[clave]
+        leido = previos is not storage.FALLO_LECTURA
+        if not leido:
+            # Sin registro no se escribe nada: se sigue con el último orden conocido
+            previos = guardado[1] if guardado else []
+        ids = list(previos)
+        conocidos = set(ids)
+        por_id = {}
+        for valor in lista:
+            id_item = catalogo.id_contenido(valor)
+            por_id[id_item] = valor
+            if id_item not in conocidos:
+                conocidos.add(id_item)
+                ids.append(id_item)
+        if leido and len(ids) != len(previos):
+            storage.guardar_lista(clave, ids)
+        orden = [por_id.get(id_item) for id_item in ids]
+        ocupados = seleccion.mascara(len(orden), [i for i, valor in enumerate(orden) if valor is None])
+        if leido:
+            _orden_seleccion[categoria] = (lista, ids, orden, ocupados)
+        return orden, ocupados
+
+def siguiente_en_orden(lista, categoria, cursor=None, semilla=None):
+    """Siguiente elemento de un cursor sobre el orden estable (saltando huecos): (valor, cursor)"""
+    orden, _ = orden_seleccion(lista, categoria)
+    for _ in range(2 * len(orden)):
+        indice, cursor = seleccion.siguiente(len(orden), cursor, semilla)
+        if orden[indice] is not None:
+            return orden[indice], cursor
+    raise ValueError("No hay contenido para elegir")
+
+def siguiente_bitset_en_orden(lista, categoria, texto=None, rng=random):
+    """Elemento al azar no visto según el orden estable: (valor, mapa actualizado)"""
+    orden, ocupados = orden_seleccion(lista, categoria)
+    indice, texto = seleccion.siguiente_bitset(len(orden), texto, rng, ocupados)
+    return orden[indice], texto
+
+def obtener_sin_repetir(lista, usados_key, user_id=None, estado=None):
+    """Obtiene un elemento aleatorio sin repetir hasta agotar la lista (por usuario).
+    El historial guarda IDs de contenido (ver catalogo.py), no el texto completo.
+    Si se pasa el estado ya cargado, solo se modifica en memoria y lo guarda quien llama."""
+    guardar = estado is None
+    if estado is None:
+        estado = cargar_historial(user_id)
+    
+    if seleccion.MODO == 'cursor':
+        cursores = estado.setdefault('cursor', {})
+        elegido, cursores[usados_key] = siguiente_en_orden(lista, usados_key, cursores.get(usados_key))
+        if guardar:
+            guardar_historial(estado, user_id)
+        return elegido
+    
+    if seleccion.MODO == 'bitset':
+        mapas = estado.setdefault('bits', {})
+        elegido, mapas[usados_key] = siguiente_bitset_en_orden(lista, usados_key, mapas.get(usados_key))
+        if guardar:
+            guardar_historial(estado, user_id)
+        return elegido
+    
+    usados = catalogo.normalizar_usados(estado.get(usados_key, []))
+    usados_ids = set(usados)
+    disponibles = [item for item in lista if catalogo.id_contenido(item) not in usados_ids]
     
     if not disponibles:
         usados = []
         disponibles = lista.copy()
     
     elegido = random.choice(disponibles)
-    usados.append(elegido)
+    usados.append(catalogo.id_contenido(elegido))
+    estado[usados_key] = usados
     
-    # Guardar en la estructura correcta
-    if user_id:
-        estado[user_key][usados_key] = usados
-    else:
-        estado[usados_key] = usados
-    guardar_estado(estado)
+    if guardar:
+        guardar_historial(estado, user_id)
     
     return elegido
 
-def obtener_efemeride():
+def contar_usados(estado, usados_key):
+    """Cuántos elementos de una categoría ha visto ya el usuario en la vuelta actual"""
+    if seleccion.MODO == 'cursor':
+        return seleccion.vistos(estado.get('cursor', {}).get(usados_key))
+    if seleccion.MODO == 'bitset':
+        return seleccion.contar_bits(seleccion.bits_desde_texto(estado.get('bits', {}).get(usados_key)))
+    return len(estado.get(usados_key, []))
+
+def obtener_efemeride(hoy=None):
     """Obtiene una efeméride del día - primero curada, luego Wikipedia como fallback"""
-    hoy = datetime.now()
+    hoy = hoy or datetime.now()
     
     # Primero intentar con el diccionario curado
-    efemeride_curada = EFEMERIDES.get((hoy.month, hoy.day))
+    efemeride_curada = catalogo.tabla('efemerides').get((hoy.month, hoy.day))
     if efemeride_curada:
         return efemeride_curada
     
@@ -462,15 +657,15 @@ def obtener_efemeride():
         print(f"Error obteniendo efeméride: {e}")
     return None
 
-def obtener_dia_internacional():
+def obtener_dia_internacional(hoy=None):
     """Obtiene el día internacional de hoy"""
-    hoy = datetime.now()
-    return DIAS_INTERNACIONALES.get((hoy.month, hoy.day), None)
+    hoy = hoy or datetime.now()
+    return catalogo.tabla('dias_internacionales').get((hoy.month, hoy.day), None)
 
-def obtener_mito_diario():
+def obtener_mito_diario(fecha_hoy=None):
     """Obtiene el mito del día sin repetir hasta agotar todos"""
     estado = cargar_estado()
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
+    fecha_hoy = fecha_hoy or datetime.now().strftime("%Y-%m-%d")
     
     # Si ya tenemos mito para hoy, devolverlo
     if estado.get('mito_fecha') == fecha_hoy and 'mito_actual' in estado:
@@ -478,16 +673,32 @@ def obtener_mito_diario():
     
     # Obtener nuevo mito sin repetir
     todos_mitos = obtener_todos_mitos()
-    mitos_usados = estado.get('mitos_usados', [])
+    import hashlib
+    semilla = int(hashlib.md5(fecha_hoy.encode()).hexdigest(), 16) % (2**32)
+    
+    if seleccion.MODO == 'cursor':
+        # Cursor global (mismo mito para todos); la semilla del día baraja cada vuelta nueva
+        cursores = estado.setdefault('cursor', {})
+        mito, cursores['mitos'] = siguiente_en_orden(todos_mitos, 'mitos', cursores.get('mitos'), semilla)
+        estado['mito_fecha'] = fecha_hoy
+        estado['mito_actual'] = mito
+        guardar_estado(estado)
+        return mito
+    
+    if seleccion.MODO == 'bitset':
+        mapas = estado.setdefault('bits', {})
+        mito, mapas['mitos'] = siguiente_bitset_en_orden(
+            todos_mitos, 'mitos', mapas.get('mitos'), random.Random(semilla))
+        estado['mito_fecha'] = fecha_hoy
+        estado['mito_actual'] = mito
+        guardar_estado(estado)
+        return mito
     
-    # Convertir mitos a strings para comparación (los dicts no son hashables)
-    def mito_a_key(m):
-        if isinstance(m, dict):
-            return f"{m.get('mito', '')}|{m.get('realidad', '')}"
-        return str(m)
+    mitos_usados = catalogo.normalizar_usados(estado.get('mitos_usados', []))
     
-    usados_keys = set(mitos_usados)
-    disponibles = [m for m in todos_mitos if mito_a_key(m) not in usados_keys]
+    # Los mitos se comparan por su ID estable (los dicts no son hashables)
+    usados_ids = set(mitos_usados)
+    disponibles = [m for m in todos_mitos if catalogo.id_contenido(m) not in usados_ids]
     
     # Si no hay disponibles, reiniciar
     if not disponibles:
@@ -495,13 +706,11 @@ def obtener_mito_diario():
         disponibles = todos_mitos.copy()
     
     # Elegir uno aleatorio con semilla del día (mismo para todos)
-    import hashlib
-    semilla = int(hashlib.md5(fecha_hoy.encode()).hexdigest(), 16) % (2**32)
     rng = random.Random(semilla)
     mito = rng.choice(disponibles)
     
     # Guardar estado
-    mitos_usados.append(mito_a_key(mito))
+    mitos_usados.append(catalogo.id_contenido(mito))
     estado['mitos_usados'] = mitos_usados
     estado['mito_fecha'] = fecha_hoy
     estado['mito_actual'] = mito
@@ -509,41 +718,127 @@ def obtener_mito_diario():
     
     return mito
 
-def mensaje_diario(user_id=None):
-    """Genera el mensaje del día (personalizado por usuario si se proporciona user_id)"""
-    palabra = obtener_sin_repetir(obtener_todas_palabras(), 'palabras', user_id)
-    refran = obtener_sin_repetir(obtener_todos_refranes(), 'refranes', user_id)
-    frase = obtener_sin_repetir(obtener_todas_frases(), 'frases', user_id)
-    efemeride = obtener_efemeride()
-    dia_internacional = obtener_dia_internacional()
-    mito = obtener_mito_diario()
-    
-    mensaje = f"""
-🦪 *PERLA DEL DÍA*
-
-📚 *Palabra curiosa:*
-{palabra}
-
-🎯 *Refrán:*
-{refran}
+# ============== CONTEXTO DIARIO ==============
+
+# Lo que es igual para todos durante un día (hora de España): se calcula una vez al cambiar
+# de día, se guarda en Redis para las demás réplicas y se sirve desde memoria
+REDIS_CONTEXTO_DIARIO = 'contexto_diario'
+_contexto_diario = None
+_contexto_hasta = 0
+_contexto_lock = threading.Lock()
+
+def construir_contexto_diario(fecha):
+    """Calcula el contexto de un día: mito, efeméride, día internacional, quiz y horóscopos"""
+    hoy = datetime.strptime(fecha, "%Y-%m-%d")
+    palabra, opciones, indice_correcto = generar_quiz(fecha)
+    return {
+        'fecha': fecha,
+        'fecha_texto': hoy.strftime('%d/%m/%Y'),
+        'mito': obtener_mito_diario(fecha),
+        'efemeride': obtener_efemeride(hoy),
+        'dia_internacional': obtener_dia_internacional(hoy),
+        'quiz': {'palabra': palabra, 'opciones': opciones, 'indice_correcto': indice_correcto},
+        'horoscopo': predicciones_del_dia(fecha),
+    }
 
-😂 *Frase mítica:*
-{frase}
+def fin_del_dia_spain(ahora):
+    """Timestamp de la próxima medianoche en España (cuando cambia el contexto diario)"""
+    manana = (ahora + timedelta(days=1)).date()
+    return TIMEZONE_SPAIN.localize(datetime(manana.year, manana.month, manana.day)).timestamp()
+
+def obtener_contexto_diario():
+    """Contexto del día actual: en memoria si ya se calculó, si no de Redis o se construye"""
+    global _contexto_diario, _contexto_hasta
+    contexto = _contexto_diario
+    if contexto is not None and time.time() < _contexto_hasta:
+        return contexto
+    with _contexto_lock:
+        if _contexto_diario is not None and time.time() < _contexto_hasta:
+            return _contexto_diario
+        ahora = hora_spain()
+        fecha = ahora.strftime("%Y-%m-%d")
+        contexto = storage.obtener_dict(REDIS_CONTEXTO_DIARIO)
+        if contexto.get('fecha') != fecha:
+            contexto = construir_contexto_diario(fecha)
+            storage.guardar_dict(REDIS_CONTEXTO_DIARIO, contexto)
+            print(f"🗓️ Contexto diario calculado para {fecha}")
+        _contexto_diario = contexto
+        _contexto_hasta = fin_del_dia_spain(ahora)
+        return contexto
+
+@recarga.al_recargar
+def invalidar_contexto_diario():
+    """Descarta el contexto y los segmentos renderizados (p.ej. tras recargar el contenido)"""
+    global _contexto_diario, _contexto_hasta
+    with _contexto_lock:
+        _contexto_diario = None
+        _contexto_hasta = 0
+        storage.borrar(REDIS_CONTEXTO_DIARIO)
+    plantillas.limpiar()
+
+def renderizar_mensaje_diario(palabra, refran, frase, contexto):
+    """Compone el Markdown del mensaje del día (segmentos cacheados, ver plantillas.py)"""
+    return plantillas.mensaje_diario(palabra, refran, frase, contexto)
 
-🔍 *Mito desmontado:*
-❌ _{mito['mito']}_
-✅ {mito['realidad']}
-"""
-    
-    if dia_internacional:
-        mensaje += f"\n🌐 *Hoy se celebra:*\n{dia_internacional}\n"
-    
-    if efemeride:
-        mensaje += f"\n📅 *Tal día como hoy:*\n{efemeride}\n"
-    
-    mensaje += f"\n_{datetime.now().strftime('%d/%m/%Y')}_"
-    
-    return mensaje
+def mensaje_diario(user_id=None):
+    """Genera el mensaje del día (personalizado por usuario si se proporciona user_id)"""
+    if user_id:
+        precargar(clave_estado_usuario(user_id), *CLAVES_MENSAJE_DIARIO)
+    else:
+        precargar(*CLAVES_MENSAJE_DIARIO)
+    
+    # Un solo viaje de ida y vuelta para el historial: cargar, elegir las tres cosas, guardar
+    estado = cargar_historial(user_id)
+    palabra = obtener_sin_repetir(obtener_todas_palabras(), 'palabras', user_id, estado)
+    refran = obtener_sin_repetir(obtener_todos_refranes(), 'refranes', user_id, estado)
+    frase = obtener_sin_repetir(obtener_todas_frases(), 'frases', user_id, estado)
+    guardar_historial(estado, user_id)
+    
+    return renderizar_mensaje_diario(palabra, refran, frase, obtener_contexto_diario())
+
+def generar_mensajes_diarios(user_ids):
+    """Genera el mensaje del día de muchos usuarios de una pasada: lee todos los historiales
+    con MGET, elige en memoria y los guarda con MSET. Devuelve {user_id: mensaje}.
+    Los usuarios cuyo historial no se pudo leer (ni al reintentar) se omiten: nunca se
+    sobrescribe un historial con uno vacío por un fallo de lectura."""
+    if not user_ids:
+        return {}
+    migrar_estado_por_usuario()
+    precargar(*CLAVES_MENSAJE_DIARIO)
+    
+    # Lo común a todos se calcula una vez
+    palabras = obtener_todas_palabras()
+    refranes = obtener_todos_refranes()
+    frases = obtener_todas_frases()
+    contexto = obtener_contexto_diario()
+    
+    claves = {user_id: clave_estado_usuario(user_id) for user_id in user_ids}
+    estados = storage.obtener_muchos(claves.values(), cachear=False, marcar_fallos=True)
+    fallidas = [clave for clave, estado in estados.items() if estado is storage.FALLO_LECTURA]
+    if fallidas:
+        # Un fallo puntual de Redis: se reintenta una vez solo lo que falló
+        estados.update(storage.obtener_muchos(fallidas, cachear=False, marcar_fallos=True))
+    
+    mensajes = {}
+    nuevos_estados = {}
+    omitidos = 0
+    for user_id, clave in claves.items():
+        estado = estados.get(clave)
+        if estado is storage.FALLO_LECTURA:
+            omitidos += 1
+            continue
+        estado = estado or {'palabras': [], 'refranes': [], 'frases': []}
+        palabra = obtener_sin_repetir(palabras, 'palabras', user_id, estado)
+        refran = obtener_sin_repetir(refranes, 'refranes', user_id, estado)
+        frase = obtener_sin_repetir(frases, 'frases', user_id, estado)
+        nuevos_estados[clave] = estado
+        mensajes[user_id] = renderizar_mensaje_diario(palabra, refran, frase, contexto)
+    
+    if omitidos:
+        print(f"⚠️ {omitidos} usuarios sin mensaje: no se pudo leer su historial")
+    if nuevos_estados and not storage.guardar_muchos(nuevos_estados, cachear=False):
+        print(f"⚠️ No se pudo guardar el historial de {len(nuevos_estados)} usuarios")
+    return mensajes
 
 def crear_botones_voto(fecha):
     """Crea los botones de votación"""
@@ -554,35 +849,49 @@ def crear_botones_voto(fecha):
     markup.add(btn_up, btn_down)
     return markup
 
-def enviar_mensaje():
-    """Envía el mensaje diario a todos los usuarios registrados (personalizado por usuario)"""
+def envios_mensaje_diario():
+    """Genera el mensaje diario de cada suscrito (y guarda su historial) como envíos de difusión"""
+    precargar(REDIS_USUARIOS, REDIS_VOTOS, *CLAVES_MENSAJE_DIARIO)
     usuarios = cargar_usuarios()
     fecha = datetime.now().strftime("%Y-%m-%d")
-    markup = crear_botones_voto(fecha)
+    markup = crear_botones_voto(fecha).to_json()
     
-    enviados = 0
-    errores = 0
+    # Mensajes personalizados de todos los suscritos, generados de una pasada
+    suscritos = {user_id: data for user_id, data in usuarios.items() if es_suscrito(data)}
+    mensajes = generar_mensajes_diarios(list(suscritos))
     
-    for user_id, data in usuarios.items():
-        chat_id = data.get('chat_id')
-        if not chat_id:
-            continue
-        
-        try:
-            # Mensaje personalizado por usuario
-            mensaje = mensaje_diario(user_id)
-            bot.send_message(
-                chat_id, 
-                mensaje, 
-                parse_mode='Markdown',
-                reply_markup=markup
-            )
-            enviados += 1
-        except Exception as e:
-            errores += 1
-            print(f"Error enviando a {data.get('nombre', user_id)}: {e}")
-    
-    print(f"Mensaje diario enviado: {enviados} OK, {errores} errores - {datetime.now()}")
+    return [(user_id, data['chat_id'], mensajes[user_id], {'parse_mode': 'Markdown', 'reply_markup': markup})
+            for user_id, data in suscritos.items() if user_id in mensajes]
+
+def preparar_mensaje_diario():
+    """Genera y guarda antes de la hora los mensajes de la perla de hoy (09:45)"""
+    inicio = time.perf_counter()
+    tarea = difusion.preparar_tarea(id_difusion('perla'), envios_mensaje_diario, 'perla')
+    if tarea:
+        print(f"Perla preparada: {tarea['total']} mensajes en {time.perf_counter() - inicio:.1f}s - {datetime.now()}")
+
+def enviar_mensaje():
+    """Envía el mensaje diario a todos los usuarios registrados (personalizado por usuario)"""
+    # Tarea persistente: si ya se preparó a las 09:45 solo se envía; si el proceso se
+    # reinicia a mitad, sigue sin regenerar ni repetir
+    resultado = difusion.difundir_tarea(id_difusion('perla'), envios_mensaje_diario, bot.send_message, 'perla')
+    
+    print(f"Mensaje diario enviado: {resultado['enviados']} OK, {resultado['errores']} errores "
+          f"en {resultado['segundos']:.1f}s - {datetime.now()}")
+    metricas = resultado['metricas']
+    if metricas:
+        print(f"   {metricas['msg_segundo']:.1f} msg/s, última entrega a los {metricas['ultima'] or 0:.1f}s, "
+              f"latencia p50 {metricas['latencia_ms']['p50']:.0f}ms p99 {metricas['latencia_ms']['p99']:.0f}ms, "
+              f"{metricas['reintentos']} reintentos")
+
+def id_difusion(nombre):
+    """ID de la tarea de difusión programada de hoy (p.ej. 'perla:2024-05-01')"""
+    return f"{nombre}:{fecha_spain()}"
+
+def envios_a_suscritos(usuarios, texto, **opciones):
+    """Envíos del mismo texto a todos los usuarios con chat_id (para difusion.difundir)"""
+    return [(user_id, data['chat_id'], texto, opciones)
+            for user_id, data in usuarios.items() if es_suscrito(data)]
 
 def enviar_resumen_semanal():
     """Envía el resumen del ranking semanal (lunes a las 8:00)"""
@@ -640,19 +949,12 @@ def enviar_resumen_semanal():
     texto += "\n\n_Nueva semana, borrón y cuenta nueva. A ver quién manda ahora._"
     
     # Enviar a todos los usuarios suscritos
-    usuarios = cargar_usuarios()
-    enviados = 0
-    for user_id, data in usuarios.items():
-        chat_id = data.get('chat_id')
-        if not chat_id:
-            continue
-        try:
-            bot.send_message(chat_id, texto, parse_mode='Markdown')
-            enviados += 1
-        except:
-            pass
+    resultado = difusion.difundir_tarea(
+        id_difusion('semanal'),
+        lambda: envios_a_suscritos(cargar_usuarios(), texto, parse_mode='Markdown'),
+        bot.send_message, 'semanal')
     
-    print(f"Resumen semanal enviado a {enviados} usuarios - {datetime.now()}")
+    print(f"Resumen semanal enviado a {resultado['enviados']} usuarios - {datetime.now()}")
 
 def enviar_resumen_mensual():
     """Envía el resumen del ranking mensual (día 1 a las 8:00)"""
@@ -692,26 +994,22 @@ def enviar_resumen_mensual():
     texto += "\n\n_Nuevo mes, contador a cero. Que tiemble quien tenga que temblar._"
     
     # Enviar a todos los usuarios suscritos
-    usuarios = cargar_usuarios()
-    enviados = 0
-    for user_id, data in usuarios.items():
-        chat_id = data.get('chat_id')
-        if not chat_id:
-            continue
-        try:
-            bot.send_message(chat_id, texto, parse_mode='Markdown')
-            enviados += 1
-        except:
-            pass
+    resultado = difusion.difundir_tarea(
+        id_difusion('mensual'),
+        lambda: envios_a_suscritos(cargar_usuarios(), texto, parse_mode='Markdown'),
+        bot.send_message, 'mensual')
     
-    print(f"Resumen mensual enviado a {enviados} usuarios - {datetime.now()}")
+    print(f"Resumen mensual enviado a {resultado['enviados']} usuarios - {datetime.now()}")
 
 # Recordatorio del desafío a las 20:00 (11h después de la perla)
 def enviar_recordatorio_desafio():
     """Recuerda a los usuarios que no han jugado el desafío hoy"""
     usuarios = cargar_usuarios()
-    usos_desafio = storage.obtener_dict(REDIS_USOS_DESAFIO)
-    fecha_hoy = hora_spain().strftime("%Y-%m-%d")
+    fecha_hoy = fecha_spain()
+    
+    # Un solo barrido MGET de los contadores de hoy (sin llenar la caché local)
+    claves = {user_id: clave_cuota(REDIS_USOS_DESAFIO, user_id, fecha_hoy) for user_id in usuarios}
+    usos_desafio = storage.obtener_muchos(claves.values(), default=0, cachear=False)
     
     mensajes_recordatorio = [
         "🎯 ¡Ey! Hoy no has jugado al /desafio. Estás regalando puntos del ranking. ¿Seguro que quieres que otros te adelanten?",
@@ -750,28 +1048,23 @@ def enviar_recordatorio_desafio():
     dia_año = hora_spain().timetuple().tm_yday
     mensaje = mensajes_recordatorio[dia_año % len(mensajes_recordatorio)]
     
-    enviados = 0
-    for user_id, data in usuarios.items():
-        chat_id = data.get('chat_id')
-        if not chat_id:
-            continue
-        
-        # Verificar si ya jugó hoy
-        clave = f"{user_id}_{fecha_hoy}"
-        if usos_desafio.get(clave, False):
-            continue  # Ya jugó, no recordar
-        
-        try:
-            bot.send_message(chat_id, mensaje)
-            enviados += 1
-        except:
-            pass
+    # Solo a quien no ha jugado hoy
+    pendientes = {user_id: data for user_id, data in usuarios.items()
+                  if not usos_desafio.get(claves[user_id], 0)}
+    resultado = difusion.difundir_tarea(id_difusion('recordatorio'), lambda: envios_a_suscritos(pendientes, mensaje),
+                                        bot.send_message, 'recordatorio')
     
-    print(f"Recordatorio desafío enviado a {enviados} usuarios - {hora_spain()}")
+    print(f"Recordatorio desafío enviado a {resultado['enviados']} usuarios - {hora_spain()}")
 
 # === TAREAS PROGRAMADAS CON HORA ESPAÑOLA ===
-# Control para evitar ejecuciones duplicadas
-TAREAS_EJECUTADAS = {}
+# Control para evitar ejecuciones duplicadas (se guarda en Redis para sobrevivir a reinicios)
+REDIS_TAREAS = 'tareas_ejecutadas'
+TAREAS_EJECUTADAS = None  # se carga de Redis en la primera comprobación
+
+def marcar_tarea(tarea, fecha):
+    """Marca una tarea programada como hecha hoy (en memoria y en Redis)"""
+    TAREAS_EJECUTADAS[tarea] = fecha
+    storage.guardar_dict(REDIS_TAREAS, TAREAS_EJECUTADAS)
 
 def ejecutar_tareas_programadas():
     """Verifica y ejecuta tareas según hora española"""
@@ -782,32 +1075,45 @@ def ejecutar_tareas_programadas():
     dia_semana = ahora.weekday()  # 0=lunes
     dia_mes = ahora.day
     
+    if TAREAS_EJECUTADAS is None:
+        TAREAS_EJECUTADAS = storage.obtener_dict(REDIS_TAREAS)
+    
     # Limpiar tareas de días anteriores
     TAREAS_EJECUTADAS = {k: v for k, v in TAREAS_EJECUTADAS.items() if v == fecha_hoy}
     
+    # Las horas se comparan con >=: TAREAS_EJECUTADAS está en Redis, así que si un reinicio se come
+    # el minuto exacto, la tarea se hace en la siguiente comprobación en vez de perderse ese día
+    
+    # 09:45 - Preparar la perla (mensajes e historiales) para que a las 10:00 solo se envíe
+    if (hora_actual >= "09:45" and "preparar_perla" not in TAREAS_EJECUTADAS
+            and "perla" not in TAREAS_EJECUTADAS):
+        print(f"[{ahora}] Preparando perla diaria...")
+        preparar_mensaje_diario()
+        marcar_tarea("preparar_perla", fecha_hoy)
+    
     # 10:00 - Perla diaria
-    if hora_actual == "10:00" and "perla" not in TAREAS_EJECUTADAS:
+    if hora_actual >= "10:00" and "perla" not in TAREAS_EJECUTADAS:
         print(f"[{ahora}] Ejecutando perla diaria...")
         enviar_mensaje()
-        TAREAS_EJECUTADAS["perla"] = fecha_hoy
+        marcar_tarea("perla", fecha_hoy)
         
         # Resumen semanal (lunes)
         if dia_semana == 0 and "semanal" not in TAREAS_EJECUTADAS:
             print(f"[{ahora}] Ejecutando resumen semanal...")
             enviar_resumen_semanal()
-            TAREAS_EJECUTADAS["semanal"] = fecha_hoy
+            marcar_tarea("semanal", fecha_hoy)
         
         # Resumen mensual (día 1)
         if dia_mes == 1 and "mensual" not in TAREAS_EJECUTADAS:
             print(f"[{ahora}] Ejecutando resumen mensual...")
             enviar_resumen_mensual()
-            TAREAS_EJECUTADAS["mensual"] = fecha_hoy
+            marcar_tarea("mensual", fecha_hoy)
     
     # 20:00 - Recordatorio del desafío
-    if hora_actual == "20:00" and "recordatorio" not in TAREAS_EJECUTADAS:
+    if hora_actual >= "20:00" and "recordatorio" not in TAREAS_EJECUTADAS:
         print(f"[{ahora}] Ejecutando recordatorio desafío...")
         enviar_recordatorio_desafio()
-        TAREAS_EJECUTADAS["recordatorio"] = fecha_hoy
+        marcar_tarea("recordatorio", fecha_hoy)
 
 # Ejecutar verificación cada minuto
 schedule.every(1).minutes.do(ejecutar_tareas_programadas)
@@ -843,25 +1149,62 @@ def obtener_chat_id(message):
     bot.reply_to(message, f"Tu Chat ID es: {chat_id}")
     print(f"Chat ID: {chat_id}")
 
+# === CUOTAS DIARIAS (contadores atómicos en Redis, uno por usuario y día) ===
+
+def clave_cuota(prefijo, user_id, fecha):
+    """Clave del contador diario de un usuario: prefijo:user_id:fecha"""
+    return f"{prefijo}:{user_id}:{fecha}"
+
+def expiracion_cuota(fecha):
+    """Timestamp en el que Redis borra el contador (fin del día siguiente, margen para husos horarios)"""
+    return (datetime.strptime(fecha, "%Y-%m-%d") + timedelta(days=2)).timestamp()
+
+def obtener_cuota(prefijo, user_id, fecha=None):
+    """Devuelve el valor del contador diario del usuario (por fecha de España)"""
+    fecha = fecha or fecha_spain()
+    return int(storage.obtener(clave_cuota(prefijo, user_id, fecha), 0))
+
+def incrementar_cuota(prefijo, user_id, fecha=None):
+    """Incrementa de forma atómica el contador diario del usuario y devuelve el nuevo valor"""
+    fecha = fecha or fecha_spain()
+    return storage.incrementar(clave_cuota(prefijo, user_id, fecha), expira_en=expiracion_cuota(fecha))
+
+def migrar_cuotas_antiguas():
+    """Pasa los usos de hoy de los blobs antiguos (usos_ahora, usos_desafio, usos_oscura: {"user_fecha": n})
+    a los contadores por usuario y borra los blobs, para que nadie estrene una segunda cuota al desplegar"""
+    # Solo migra una réplica: si dos lo hicieran a la vez, los usos se sumarían dos veces
+    if storage.incrementar(REDIS_MIGRACION_CUOTAS, expira_en=time.time() + 86400) != 1:
+        return
+    fecha_hoy = fecha_spain()
+    # El formato antiguo usaba la fecha del servidor, que de madrugada aún puede ir por detrás
+    fechas_hoy = {fecha_hoy, datetime.now().strftime("%Y-%m-%d")}
+    migrados = 0
+    for prefijo in (REDIS_USOS_AHORA, REDIS_USOS_DESAFIO, REDIS_USOS_OSCURA):
+        antiguos = storage.obtener_dict(prefijo)
+        if not antiguos:
+            continue
+        for clave, usos in antiguos.items():
+            user_id, _, fecha = clave.rpartition('_')
+            if fecha not in fechas_hoy:
+                continue
+            for _ in range(int(usos) - obtener_cuota(prefijo, user_id, fecha_hoy)):
+                if not incrementar_cuota(prefijo, user_id, fecha_hoy):
+                    # Se deja el blob y se libera la migración para reintentarla en el próximo arranque
+                    print(f"⚠️ Migración de {prefijo} interrumpida, se reintentará")
+                    storage.borrar(REDIS_MIGRACION_CUOTAS)
+                    return
+                migrados += 1
+        storage.borrar(prefijo)
+    if migrados:
+        print(f"✅ Cuotas antiguas migradas: {migrados} usos")
+
 def obtener_usos_ahora(user_id):
     """Obtiene cuántas veces ha usado /ahora hoy"""
-    usos = storage.obtener_dict(REDIS_USOS_AHORA)
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
-    clave = f"{user_id}_{fecha_hoy}"
-    return usos.get(clave, 0)
+    return obtener_cuota(REDIS_USOS_AHORA, user_id)
 
 def incrementar_usos_ahora(user_id):
     """Incrementa el contador de usos de /ahora"""
-    usos = storage.obtener_dict(REDIS_USOS_AHORA)
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
-    clave = f"{user_id}_{fecha_hoy}"
-    
-    # Limpiar usos de días anteriores
-    usos = {k: v for k, v in usos.items() if k.endswith(fecha_hoy)}
-    
-    usos[clave] = usos.get(clave, 0) + 1
-    storage.guardar_dict(REDIS_USOS_AHORA, usos)
-    return usos[clave]
+    return incrementar_cuota(REDIS_USOS_AHORA, user_id)
 
 MENSAJES_LIMITE_AHORA = [
     # 2º intento - jocoso
@@ -876,6 +1219,9 @@ MENSAJES_LIMITE_AHORA = [
 
 @bot.message_handler(commands=['ahora'])
 def send_now(message):
+    fecha_hoy = fecha_spain()
+    precargar(REDIS_USUARIOS, REDIS_VOTOS, clave_cuota(REDIS_USOS_AHORA, message.from_user.id, fecha_hoy),
+              clave_estado_usuario(message.from_user.id), *CLAVES_MENSAJE_DIARIO)
     registrar_usuario(message.from_user)
     user_id = message.from_user.id
     
@@ -1453,17 +1799,121 @@ def reset_perla_usuario(message):
         return
     
     # Resetear usos
-    usos = storage.obtener_dict(REDIS_USOS_AHORA)
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
-    clave = f"{target_id}_{fecha_hoy}"
-    
-    if clave in usos:
-        del usos[clave]
-        storage.guardar_dict(REDIS_USOS_AHORA, usos)
+    fecha_hoy = fecha_spain()
+    if storage.borrar(clave_cuota(REDIS_USOS_AHORA, target_id, fecha_hoy)):
         bot.reply_to(message, f"✅ Reseteados los usos de /ahora para {target_name}. Ya puede pedir su perla.")
     else:
         bot.reply_to(message, f"ℹ️ {target_name} no tenía usos registrados hoy.")
 
+@bot.message_handler(commands=['limpiarcache'])
+def limpiar_cache(message):
+    """Vacía la caché local de almacenamiento (solo admin)"""
+    if str(message.chat.id) != str(CHAT_ID):
+        bot.reply_to(message, "⛔ Este comando es solo para administradores.")
+        return
+
+    # Puede ser /limpiarcache (todo) o /limpiarcache clave
+    clave = message.text.replace('/limpiarcache', '', 1).strip()
+    storage.invalidar(clave or None)
+
+    if clave:
+        bot.reply_to(message, f"🧹 Caché invalidada para la clave {clave}")
+    else:
+        bot.reply_to(message, "🧹 Caché local vaciada. La próxima lectura irá a Redis.")
+
+@bot.message_handler(commands=['recargar'])
+def recargar_contenido(message):
+    """Recarga contenido.py, efemerides.py y dias_internacionales.py sin reiniciar (solo admin)"""
+    if str(message.chat.id) != str(CHAT_ID):
+        bot.reply_to(message, "⛔ Este comando es solo para administradores.")
+        return
+
+    totales = recarga.recargar()
+    if totales is None:
+        bot.reply_to(message, "⚠️ El contenido nuevo tiene errores; se mantiene el anterior (ver logs).")
+        return
+    resumen = "\n".join(f"• {nombre}: {n}" for nombre, n in totales.items())
+    bot.reply_to(message, f"♻️ Contenido recargado:\n{resumen}")
+
+@bot.message_handler(commands=['conexiones'])
+def ver_conexiones(message):
+    """Muestra la reutilización de conexiones HTTP con el almacenamiento (solo admin)"""
+    if str(message.chat.id) != str(CHAT_ID):
+        bot.reply_to(message, "⛔ Este comando es solo para administradores.")
+        return
+    
+    stats = storage.estadisticas_conexiones()
+    if not stats:
+        bot.reply_to(message, f"ℹ️ El backend {storage.STORAGE_BACKEND} no usa conexiones HTTP.")
+        return
+    
+    pct = int(stats['reutilizadas'] / stats['peticiones'] * 100) if stats['peticiones'] else 0
+    bot.reply_to(message,
+        f"🔌 *Conexiones con Upstash*\n\n"
+        f"Peticiones: {stats['peticiones']}\n"
+        f"Conexiones nuevas (handshakes TLS): {stats['conexiones_nuevas']}\n"
+        f"Reutilizadas: {stats['reutilizadas']} ({pct}%)\n"
+        f"Tamaño del pool: {stats['pool_max']}",
+        parse_mode='Markdown')
+
+@bot.message_handler(commands=['metricas'])
+def ver_metricas(message):
+    """Muestra las métricas de almacenamiento por clave y por handler (solo admin)"""
+    if str(message.chat.id) != str(CHAT_ID):
+        bot.reply_to(message, "⛔ Este comando es solo para administradores.")
+        return
+    
+    datos = storage.metricas()
+    if not datos['claves']:
+        bot.reply_to(message, "📈 Aún no hay métricas de almacenamiento.")
+        return
+    
+    def kb(n):
+        return f"{n / 1024:.1f} KB"
+    
+    texto = "📈 MÉTRICAS DE ALMACENAMIENTO\n\n🔑 Claves (por uso):\n"
+    claves = sorted(datos['claves'].items(), key=lambda x: x[1]['lecturas'] + x[1]['escrituras'], reverse=True)
+    for familia, m in claves[:10]:
+        texto += (f"• {familia}: {m['lecturas']}L/{m['escrituras']}E, caché {m['aciertos_cache']}, "
+                  f"p50 {m['p50_ms']:.0f}ms p95 {m['p95_ms']:.0f}ms, "
+                  f"↓{kb(m['bytes_leidos'])} ↑{kb(m['bytes_escritos'])}\n")
+    
+    texto += "\n⏱️ Handlers (por tiempo en almacenamiento):\n"
+    origenes = sorted(datos['origenes'].items(), key=lambda x: x[1]['segundos'], reverse=True)
+    for origen, m in origenes[:10]:
+        texto += f"• {origen}: {m['llamadas']} llamadas, {m['peticiones_red']} a red, {m['segundos']:.2f}s, {kb(m['bytes'])}\n"
+    
+    bot.reply_to(message, texto)
+
+@bot.message_handler(commands=['difusiones'])
+def ver_difusiones(message):
+    """Muestra las métricas de las últimas difusiones (solo admin)"""
+    if str(message.chat.id) != str(CHAT_ID):
+        bot.reply_to(message, "⛔ Este comando es solo para administradores.")
+        return
+    
+    ejecuciones = difusion.cargar_metricas()
+    if not ejecuciones:
+        bot.reply_to(message, "📡 Aún no hay difusiones registradas.")
+        return
+    
+    def segundos(valor):
+        return f"{valor:.1f}s" if valor is not None else "-"
+    
+    texto = "📡 ÚLTIMAS DIFUSIONES\n"
+    for m in reversed(ejecuciones[-8:]):
+        inicio = datetime.fromtimestamp(m['inicio'], TIMEZONE_SPAIN).strftime("%d/%m %H:%M")
+        lat = m['latencia_ms']
+        texto += (f"\n• {m['id']} ({inicio})\n"
+                  f"  {m['enviados']}/{m['total']} OK en {segundos(m['segundos'])}, {m['msg_segundo']:.1f} msg/s\n"
+                  f"  1ª entrega {segundos(m['primera'])}, última {segundos(m['ultima'])}\n"
+                  f"  latencia p50 {lat['p50']:.0f}ms p90 {lat['p90']:.0f}ms p99 {lat['p99']:.0f}ms máx {lat['max']:.0f}ms\n")
+        if m['errores'] or m['reintentos']:
+            tipos = ", ".join(f"{tipo} {n}" for tipo, n in sorted(m['por_tipo'].items())) or "-"
+            texto += f"  errores: {tipos} · reintentos {m['reintentos']}\n"
+    
+    bot.reply_to(message, texto)
+
 @bot.message_handler(commands=['altavoz'])
 def broadcast_mensaje(message):
     """Envía un mensaje a todos los usuarios (solo admin)"""
@@ -1484,24 +1934,21 @@ def broadcast_mensaje(message):
         return
     
     usuarios = cargar_usuarios()
-    enviados = 0
-    errores = 0
+    envios = envios_a_suscritos(usuarios, f"📢 *MENSAJE DEL BOT*\n\n{texto_broadcast}", parse_mode='Markdown')
     
-    for user_id, data in usuarios.items():
-        chat_id = data.get('chat_id')
-        if not chat_id:
-            continue
-        try:
-            bot.send_message(chat_id, f"📢 *MENSAJE DEL BOT*\n\n{texto_broadcast}", parse_mode='Markdown')
-            enviados += 1
-        except Exception as e:
-            errores += 1
+    # Con muchos usuarios tarda minutos: se envía en segundo plano para no bloquear el handler
+    id_tarea = f"altavoz:{message.message_id}:{int(time.time())}"
+    def enviar_altavoz():
+        resultado = difusion.difundir_tarea(id_tarea, lambda: envios, bot.send_message, 'altavoz')
+        bot.reply_to(message, 
+            f"📢 *Broadcast enviado*\n\n"
+            f"✅ Enviados: {resultado['enviados']}\n"
+            f"❌ Errores: {resultado['errores']}",
+            parse_mode='Markdown')
     
-    bot.reply_to(message, 
-        f"📢 *Broadcast enviado*\n\n"
-        f"✅ Enviados: {enviados}\n"
-        f"❌ Errores: {errores}",
-        parse_mode='Markdown')
+    threading.Thread(target=enviar_altavoz, daemon=True).start()
+    if len(envios) > 100:
+        bot.reply_to(message, f"📢 Enviando a {len(envios)} usuarios...")
 
 # === PERLA OSCURA ===
 
@@ -1528,23 +1975,11 @@ def toggle_modo_oscuro(user_id):
 
 def obtener_usos_oscura(user_id):
     """Obtiene cuántas perlas oscuras ha pedido hoy"""
-    usos = storage.obtener_dict(REDIS_USOS_OSCURA) or {}
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
-    clave = f"{user_id}_{fecha_hoy}"
-    return usos.get(clave, 0)
+    return obtener_cuota(REDIS_USOS_OSCURA, user_id)
 
 def incrementar_usos_oscura(user_id):
     """Incrementa el contador de perlas oscuras del día"""
-    usos = storage.obtener_dict(REDIS_USOS_OSCURA) or {}
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
-    clave = f"{user_id}_{fecha_hoy}"
-    
-    # Limpiar usos antiguos
-    usos = {k: v for k, v in usos.items() if k.endswith(fecha_hoy)}
-    
-    usos[clave] = usos.get(clave, 0) + 1
-    storage.guardar_dict(REDIS_USOS_OSCURA, usos)
-    return usos[clave]
+    return incrementar_cuota(REDIS_USOS_OSCURA, user_id)
 
 @bot.message_handler(commands=['perlaoscura'])
 def perla_oscura(message):
@@ -1590,7 +2025,7 @@ def perla_oscura(message):
     
     # Tiene modo oscuro y no ha alcanzado el límite
     incrementar_usos_oscura(user_id)
-    perla = random.choice(PERLAS_OSCURAS)
+    perla = random.choice(catalogo.tabla('perlas_oscuras'))
     usos_restantes = 1 - usos  # 0 usos = quedan 2, 1 uso = queda 1
     
     markup = types.InlineKeyboardMarkup()
@@ -1613,7 +2048,7 @@ def handle_modo_oscuro(call):
     if accion == 'activar':
         toggle_modo_oscuro(user_id)
         incrementar_usos_oscura(user_id)  # Primera perla cuenta
-        perla = random.choice(PERLAS_OSCURAS)
+        perla = random.choice(catalogo.tabla('perlas_oscuras'))
         
         markup = types.InlineKeyboardMarkup()
         btn_otra = types.InlineKeyboardButton("🔄 Otra (1 restante)", callback_data="oscuro_otra")
@@ -1653,7 +2088,7 @@ def handle_modo_oscuro(call):
             return
         
         incrementar_usos_oscura(user_id)
-        perla = random.choice(PERLAS_OSCURAS)
+        perla = random.choice(catalogo.tabla('perlas_oscuras'))
         
         markup = types.InlineKeyboardMarkup()
         btn_desactivar = types.InlineKeyboardButton("😇 Desactivar modo", callback_data="oscuro_desactivar")
@@ -1881,7 +2316,9 @@ def procesar_signo(message):
 
 def mostrar_horoscopo(chat_id, signo, reply_to=None):
     """Muestra el horóscopo para un signo"""
-    signo_nombre, prediccion = obtener_horoscopo(signo)
+    clave_signo = normalizar_signo(signo)
+    prediccion = obtener_contexto_diario()['horoscopo'].get(clave_signo)
+    signo_nombre = SIGNOS.get(clave_signo) if prediccion else None
     
     if not signo_nombre:
         # Signo no válido: darle una predicción misteriosa igualmente
@@ -1901,26 +2338,17 @@ def mostrar_horoscopo(chat_id, signo, reply_to=None):
 
 def ya_jugo_desafio_hoy(user_id):
     """Verifica si el usuario ya jugó el desafío hoy"""
-    usos = storage.obtener_dict(REDIS_USOS_DESAFIO)
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
-    clave = f"{user_id}_{fecha_hoy}"
-    return usos.get(clave, False)
+    return obtener_cuota(REDIS_USOS_DESAFIO, user_id) > 0
 
 def marcar_desafio_jugado(user_id):
     """Marca que el usuario jugó el desafío hoy"""
-    usos = storage.obtener_dict(REDIS_USOS_DESAFIO)
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
-    clave = f"{user_id}_{fecha_hoy}"
-    
-    # Limpiar usos de días anteriores
-    usos = {k: v for k, v in usos.items() if k.endswith(fecha_hoy)}
-    
-    usos[clave] = True
-    storage.guardar_dict(REDIS_USOS_DESAFIO, usos)
+    incrementar_cuota(REDIS_USOS_DESAFIO, user_id)
 
 @bot.message_handler(commands=['desafio'])
 def enviar_desafio(message):
     """Envía un desafío de vocabulario (1 vez al día)"""
+    fecha_hoy = fecha_spain()
+    precargar(REDIS_USUARIOS, clave_cuota(REDIS_USOS_DESAFIO, message.from_user.id, fecha_hoy))
     registrar_usuario(message.from_user)
     user_id = message.from_user.id
     
@@ -1935,7 +2363,8 @@ def enviar_desafio(message):
         return
     
     # NO marcamos aquí - se marca al primer intento en el callback
-    palabra, opciones, indice_correcto = generar_quiz()
+    quiz = obtener_contexto_diario()['quiz']
+    palabra, opciones, indice_correcto = quiz['palabra'], quiz['opciones'], quiz['indice_correcto']
     
     # Escapar HTML en opciones
     def esc(text):
@@ -2122,7 +2551,7 @@ def ver_mis_estadisticas(message):
     # Racha actual (días consecutivos jugando)
     fechas_jugadas = sorted(set(r['fecha'] for r in historial), reverse=True)
     racha = 0
-    hoy = datetime.now().date()
+    hoy = hora_spain().date()
     for i, fecha_str in enumerate(fechas_jugadas):
         fecha = datetime.strptime(fecha_str, "%Y-%m-%d").date()
         esperada = hoy - timedelta(days=i)
@@ -2165,6 +2594,7 @@ def ver_mis_estadisticas(message):
 @bot.message_handler(commands=['stats'])
 def ver_stats(message):
     """Muestra estadísticas del bot"""
+    precargar(REDIS_VOTOS, REDIS_PUNTOS)
     votos = cargar_votos()
     puntos = cargar_puntos()
     
@@ -2202,28 +2632,30 @@ def ver_stats(message):
 @bot.message_handler(commands=['datos'])
 def ver_datos(message):
     """Muestra datos de contenido usado (del usuario que pregunta)"""
-    estado = cargar_estado()
+    user_id = str(message.from_user.id)
+    precargar(clave_estado_usuario(user_id), REDIS_USUARIOS, REDIS_SUGERENCIAS, *CLAVES_MENSAJE_DIARIO)
     usuarios = cargar_usuarios()
     sugerencias = cargar_sugerencias()
     frases_aprobadas = cargar_frases_aprobadas()
-    user_id = str(message.from_user.id)
     
     # Conteos del usuario actual
-    estado_usuario = estado.get(user_id, {'palabras': [], 'refranes': [], 'frases': []})
-    palabras_usadas = len(estado_usuario.get('palabras', []))
+    estado_usuario = cargar_estado_usuario(user_id)
+    palabras_usadas = contar_usados(estado_usuario, 'palabras')
     palabras_total = len(obtener_todas_palabras())
-    refranes_usados = len(estado_usuario.get('refranes', []))
+    refranes_usados = contar_usados(estado_usuario, 'refranes')
     refranes_total = len(obtener_todos_refranes())
-    frases_usadas = len(estado_usuario.get('frases', []))
+    frases_usadas = contar_usados(estado_usuario, 'frases')
     frases_total = len(obtener_todas_frases())
     
     usuarios_total = len(usuarios)
-    usuarios_suscritos = len([u for u in usuarios.values() if u.get('chat_id')])
+    usuarios_suscritos = len([u for u in usuarios.values() if es_suscrito(u)])
+    usuarios_inactivos = len([u for u in usuarios.values() if not u.get('activo', True)])
     sugerencias_pendientes = len([s for s in sugerencias if s.get('estado') == 'pendiente'])
     
     texto = "📊 *DATOS DEL BOT*\n\n"
     texto += f"👥 *Usuarios registrados:* {usuarios_total}\n"
     texto += f"📬 *Suscritos al diario:* {usuarios_suscritos}\n"
+    texto += f"🚫 *Chats inactivos:* {usuarios_inactivos}\n"
     texto += f"💡 *Sugerencias pendientes:* {sugerencias_pendientes}\n"
     texto += f"✅ *Frases aprobadas:* {len(frases_aprobadas)}\n\n"
     
@@ -2248,13 +2680,15 @@ def ver_mitos_usados(message):
         return
     
     estado = cargar_estado()
-    mitos_usados = estado.get('mitos_usados', [])
-    todos_mitos = obtener_todos_mitos()
+    mitos_usados = catalogo.normalizar_usados(estado.get('mitos_usados', []))
+    todos_mitos = obtener_todos_mitos()  # también fusiona los aprobados en el catálogo
     
     texto = f"📊 MITOS USADOS: {len(mitos_usados)}/{len(todos_mitos)}\n\n"
     
     if mitos_usados:
-        for i, key in enumerate(mitos_usados[-10:], 1):  # Últimos 10
+        for i, id_mito in enumerate(mitos_usados[-10:], 1):  # Últimos 10
+            mito = catalogo.buscar(id_mito, 'mitos')
+            key = catalogo.clave_texto(mito.valor) if mito else id_mito
             texto += f"{i}. {key[:50]}...\n"
         if len(mitos_usados) > 10:
             texto += f"\n...y {len(mitos_usados) - 10} más"
@@ -2281,20 +2715,15 @@ def marcar_mitos_usados(message):
         
         estado = cargar_estado()
         todos_mitos = obtener_todos_mitos()
-        mitos_usados = estado.get('mitos_usados', [])
-        
-        def mito_a_key(m):
-            if isinstance(m, dict):
-                return f"{m.get('mito', '')}|{m.get('realidad', '')}"
-            return str(m)
+        mitos_usados = catalogo.normalizar_usados(estado.get('mitos_usados', []))
         
-        usados_keys = set(mitos_usados)
-        disponibles = [m for m in todos_mitos if mito_a_key(m) not in usados_keys]
+        usados_ids = set(mitos_usados)
+        disponibles = [m for m in todos_mitos if catalogo.id_contenido(m) not in usados_ids]
         
         # Marcar los primeros X como usados
         marcados = 0
         for mito in disponibles[:cantidad]:
-            mitos_usados.append(mito_a_key(mito))
+            mitos_usados.append(catalogo.id_contenido(mito))
             marcados += 1
         
         estado['mitos_usados'] = mitos_usados
@@ -2312,11 +2741,15 @@ def reset_mitos_usados(message):
     
     estado = cargar_estado()
     estado['mitos_usados'] = []
+    estado.get('cursor', {}).pop('mitos', None)
+    estado.get('bits', {}).pop('mitos', None)
     if 'mito_fecha' in estado:
         del estado['mito_fecha']
     if 'mito_actual' in estado:
         del estado['mito_actual']
     guardar_estado(estado)
+    # El mito de hoy está congelado en el contexto diario (memoria y Redis): se rehace
+    invalidar_contexto_diario()
     
     bot.reply_to(message, "✅ Lista de mitos usados reiniciada")
 
@@ -2352,17 +2785,42 @@ def ver_usuarios(message):
 # Servidor HTTP simple para Render
 class HealthHandler(BaseHTTPRequestHandler):
     def do_GET(self):
+        if urlparse(self.path).path == '/metrics':
+            self.enviar_metricas()
+            return
         self.send_response(200)
         self.send_header('Content-type', 'text/plain')
         self.end_headers()
         self.wfile.write(b'Bot running')
+    def enviar_metricas(self):
+        """Métricas de almacenamiento en formato Prometheus (solo con METRICS_TOKEN definido y ?token= correcto)"""
+        token = os.environ.get('METRICS_TOKEN')
+        if not token:
+            # Sin token configurado el endpoint no existe (la URL de Render es pública)
+            self.send_response(404)
+            self.end_headers()
+            return
+        recibido = parse_qs(urlparse(self.path).query).get('token', [''])[0]
+        if not hmac.compare_digest(recibido.encode('utf-8'), token.encode('utf-8')):
+            self.send_response(403)
+            self.end_headers()
+            return
+        cuerpo = storage.metricas_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.end_headers()
+        self.wfile.write(cuerpo)
     def log_message(self, format, *args):
         pass  # Silenciar logs HTTP
 
+# Se activa cuando el servidor de health check ya escucha (sustituye a esperar 2 s a ciegas)
+health_listo = threading.Event()
+
 def run_health_server():
     port = int(os.environ.get('PORT', 10000))
     server = HTTPServer(('0.0.0.0', port), HealthHandler)
     print(f"Health server en puerto {port}")
+    health_listo.set()
     server.serve_forever()
 
 # Mantener el bot corriendo
@@ -2370,18 +2828,37 @@ def main():
     print("=" * 50)
     print("🚀 INICIANDO BOT...")
     print("=" * 50)
+    importacion = time.perf_counter() - INICIO_ARRANQUE
+    
+    # Render para el servicio con SIGTERM: salir limpio para vaciar las escrituras diferidas
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     
     # Iniciar servidor HTTP para Render PRIMERO
     threading.Thread(target=run_health_server, daemon=True).start()
-    time.sleep(2)
-    print("✅ Health server listo")
+    if health_listo.wait(timeout=10):
+        print("✅ Health server listo")
+    else:
+        print("⚠️ El health server no arrancó en 10 s, se sigue igualmente")
+    
+    # Migrar el historial por usuario si aún está en el blob antiguo
+    migrar_estado_por_usuario()
+    
+    # Pasar los usos de hoy de los blobs usos_* antiguos a los contadores diarios
+    migrar_cuotas_antiguas()
+    
+    # Vigilar los ficheros de contenido para recargarlos sin reiniciar
+    recarga.iniciar()
+    
+    # Seguir las difusiones que un reinicio dejó a medias (en segundo plano)
+    threading.Thread(target=difusion.reanudar_pendientes, args=(bot.send_message,),
+                     daemon=True, name='reanudar-difusiones').start()
     
     # Limpiar sesión de Telegram antes de conectar (evita error 409)
     try:
         import requests as req
         TOKEN = os.environ.get('TOKEN')
-        req.get(f"https://api.telegram.org/bot{TOKEN}/deleteWebhook")
-        req.get(f"https://api.telegram.org/bot{TOKEN}/getUpdates?offset=-1")
+        req.get(f"{TELEGRAM_API_URL}/bot{TOKEN}/deleteWebhook")
+        req.get(f"{TELEGRAM_API_URL}/bot{TOKEN}/getUpdates?offset=-1")
         print("✅ Sesión de Telegram limpiada")
     except Exception as e:
         print(f"⚠️ No se pudo limpiar sesión: {e}")
@@ -2409,6 +2886,8 @@ def main():
     
     threading.Thread(target=polling_con_reintentos, daemon=True).start()
     print("✅ Bot polling iniciado - ¡TODO OK!")
+    print(f"⏱️ Arranque en {time.perf_counter() - INICIO_ARRANQUE:.2f} s "
+          f"(importación {importacion:.2f} s, contenido desde {catalogo.ORIGEN})")
     
     # Ejecutar el schedule
     while True:
@@ -0,0 +1,264 @@
+# Catálogo de contenido (palabras, refranes, frases y mitos) con IDs estables
+#
+# contenido.py se procesa una sola vez en registros inmutables (Elemento) con las partes
+# ya separadas; el contenido aprobado se añade de forma incremental cuando cambia.
+# También guarda las tablas sin historial (efemérides, días internacionales y perlas
+# oscuras) para que una recarga en caliente (recarga.py) sustituya todo a la vez.
+# Cada elemento se identifica por un hash corto de su texto: no depende del orden de las
+# listas, es el mismo en todas las réplicas y sirve igual para el contenido aprobado.
+# El historial de cada usuario guarda estos IDs en lugar del texto completo.
+#
+# Para arrancar más rápido, el catálogo ya procesado se puede guardar en un snapshot
+# (python -c "import catalogo; catalogo.guardar_snapshot()" en el build). Si el snapshot
+# corresponde a los ficheros actuales, se carga de ahí sin importar los módulos de contenido.
+import os
+import pickle
+import hashlib
+import importlib
+import threading
+from collections import namedtuple
+
+MODULOS_CONTENIDO = ('contenido', 'efemerides', 'dias_internacionales')
+_DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+RUTA_SNAPSHOT = os.environ.get('CONTENIDO_SNAPSHOT', os.path.join(_DIRECTORIO, 'contenido.snapshot'))
+# Cambiar si cambia la forma de Elemento/Categoria (invalida los snapshots anteriores)
+VERSION_SNAPSHOT = 1
+
+# 5 bytes de blake2b -> 10 caracteres hex (colisiones despreciables con miles de elementos)
+BYTES_ID = 5
+LONGITUD_ID = BYTES_ID * 2
+_HEX = set('0123456789abcdef')
+
+# Memo texto -> ID (el contenido se repite en cada envío, el hash se calcula una vez)
+_ids = {}
+
+def clave_texto(item):
+    """Texto que identifica un elemento (los mitos son dicts: 'mito|realidad')"""
+    if isinstance(item, dict):
+        return f"{item.get('mito', '')}|{item.get('realidad', '')}"
+    return str(item)
+
+def id_contenido(item):
+    """ID estable y compacto de un elemento de contenido"""
+    texto = clave_texto(item)
+    id_item = _ids.get(texto)
+    if id_item is None:
+        id_item = hashlib.blake2b(texto.encode('utf-8'), digest_size=BYTES_ID).hexdigest()
+        _ids[texto] = id_item
+    return id_item
+
+def es_id(valor):
+    """True si el valor ya es un ID (y no el texto completo de versiones antiguas)"""
+    return isinstance(valor, str) and len(valor) == LONGITUD_ID and set(valor) <= _HEX
+
+def normalizar_usados(usados):
+    """Lista de usados (IDs o textos antiguos) -> lista de IDs sin duplicados, en orden"""
+    resultado = []
+    vistos = set()
+    for valor in usados or []:
+        id_item = valor if es_id(valor) else id_contenido(valor)
+        if id_item not in vistos:
+            vistos.add(id_item)
+            resultado.append(id_item)
+    return resultado
+
+# ============== REGISTROS ==============
+
+# Un elemento de contenido ya procesado. 'valor' es el original (texto o dict del mito),
+# 'definicion' va sin etimología y 'origen' es 'estatico' o 'aprobado'
+Elemento = namedtuple('Elemento', 'id categoria indice valor texto palabra definicion etimologia origen')
+
+# Contenido de una categoría: registros en orden, valores originales (mismo orden) e índice por ID
+Categoria = namedtuple('Categoria', 'elementos valores por_id estaticos')
+
+CATEGORIAS = ('palabras', 'refranes', 'frases', 'mitos')
+
+def separar_palabra(texto):
+    """'Palabra: definición (etimología)' -> (palabra, definición sin etimología, etimología)"""
+    if ':' not in texto:
+        return texto, '', ''
+    palabra, definicion = (parte.strip() for parte in texto.split(':', 1))
+    etimologia = ''
+    if '(' in definicion:
+        definicion, resto = definicion.rsplit('(', 1)
+        definicion = definicion.strip()
+        etimologia = '(' + resto
+    return palabra, definicion, etimologia
+
+def mito_valido(item):
+    """Los mitos deben ser diccionarios con 'mito' y 'realidad'"""
+    return isinstance(item, dict) and 'mito' in item and 'realidad' in item
+
+def crear_elemento(categoria, indice, valor, origen):
+    """Procesa un elemento de contenido en su registro inmutable"""
+    texto = clave_texto(valor)
+    if categoria == 'palabras':
+        palabra, definicion, etimologia = separar_palabra(texto)
+    else:
+        palabra, definicion, etimologia = '', '', ''
+    return Elemento(id_contenido(valor), categoria, indice, valor, texto,
+                    palabra, definicion, etimologia, origen)
+
+def _construir(categoria, estaticos, aprobados=(), base=None):
+    """Crea la Categoria; si se pasa la anterior, reutiliza sus registros y solo procesa lo nuevo"""
+    if base is None:
+        elementos = [crear_elemento(categoria, i, v, 'estatico') for i, v in enumerate(estaticos)]
+        n_estaticos = len(elementos)
+    else:
+        elementos = list(base.elementos)
+        n_estaticos = base.estaticos
+    for valor in aprobados:
+        elementos.append(crear_elemento(categoria, len(elementos), valor, 'aprobado'))
+    return Categoria(
+        tuple(elementos),
+        [e.valor for e in elementos],
+        {e.id: e for e in elementos},
+        n_estaticos,
+    )
+
+def _estaticos_de(modulo):
+    """Listas de cada categoría definidas en contenido.py"""
+    return {
+        'palabras': modulo.PALABRAS_CURIOSAS,
+        'refranes': modulo.REFRANES,
+        'frases': modulo.FRASES_AMIGOS,
+        'mitos': modulo.MITOS_DESMONTADOS,
+    }
+
+def _tablas_de(mod_contenido, mod_efemerides, mod_dias):
+    """Tablas de consulta directa (sin historial de usados)"""
+    return {
+        'efemerides': mod_efemerides.EFEMERIDES,
+        'dias_internacionales': mod_dias.DIAS_INTERNACIONALES,
+        'perlas_oscuras': mod_contenido.PERLAS_OSCURAS,
+    }
+
+# ============== SNAPSHOT ==============
+
+def ruta_fuente(nombre):
+    """Fichero .py de un módulo de contenido"""
+    return os.path.join(_DIRECTORIO, f"{nombre}.py")
+
+def firma_fuentes():
+    """Tamaño y fecha de modificación de los ficheros de contenido (para validar el snapshot)"""
+    firma = {}
+    for nombre in MODULOS_CONTENIDO:
+        try:
+            info = os.stat(ruta_fuente(nombre))
+            firma[nombre] = (info.st_size, info.st_mtime_ns)
+        except OSError:
+            firma[nombre] = None
+    return firma
+
+def _cargar_snapshot():
+    """Datos del snapshot si existe y corresponde a los ficheros actuales; si no, None"""
+    try:
+        with open(RUTA_SNAPSHOT, 'rb') as f:
+            datos = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"⚠️ Snapshot de contenido ilegible, se procesa contenido.py: {e}")
+        return None
+    if datos.get('version') != VERSION_SNAPSHOT or datos.get('firma') != firma_fuentes():
+        print("⚠️ Snapshot de contenido desactualizado, se procesa contenido.py")
+        return None
+    return datos
+
+def _cargar_modulos():
+    """Importa los módulos de contenido y construye el catálogo estático"""
+    modulos = [importlib.import_module(nombre) for nombre in MODULOS_CONTENIDO]
+    estaticos = _estaticos_de(modulos[0])
+    categorias = {nombre: _construir(nombre, lista) for nombre, lista in estaticos.items()}
+    return estaticos, _tablas_de(*modulos), categorias
+
+def guardar_snapshot(ruta=None):
+    """Guarda el catálogo estático ya procesado (paso de build). Devuelve la ruta"""
+    ruta = ruta or RUTA_SNAPSHOT
+    estaticos, tablas, categorias = _cargar_modulos()
+    datos = {
+        'version': VERSION_SNAPSHOT,
+        'firma': firma_fuentes(),
+        'estaticos': estaticos,
+        'tablas': tablas,
+        'categorias': categorias,
+        'ids': dict(_ids),
+    }
+    temporal = ruta + '.tmp'
+    with open(temporal, 'wb') as f:
+        pickle.dump(datos, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporal, ruta)
+    return ruta
+
+# Estado actual: cada Categoria es inmutable y se sustituye entera bajo el lock
+_snapshot = _cargar_snapshot()
+if _snapshot is not None:
+    _ESTATICOS, _tablas, _categorias = _snapshot['estaticos'], _snapshot['tablas'], _snapshot['categorias']
+    _ids.update(_snapshot['ids'])
+    ORIGEN = 'snapshot'
+else:
+    _ESTATICOS, _tablas, _categorias = _cargar_modulos()
+    ORIGEN = 'modulos'
+del _snapshot
+_aprobados_fusionados = {nombre: [] for nombre in CATEGORIAS}
+_lock = threading.Lock()
+
+def fusionar_aprobados(categoria, aprobados):
+    """Actualiza la categoría con la lista de aprobados (solo procesa los añadidos desde la última vez)"""
+    if categoria == 'mitos':
+        aprobados = [m for m in aprobados if mito_valido(m)]
+    previos = _aprobados_fusionados[categoria]
+    if len(aprobados) == len(previos) and (not previos or aprobados[-1] == previos[-1]):
+        return _categorias[categoria]
+    with _lock:
+        previos = _aprobados_fusionados[categoria]
+        actual = _categorias[categoria]
+        n = len(previos)
+        if len(aprobados) >= n and aprobados[:n] == previos:
+            # Lo habitual: solo se han añadido aprobados al final
+            nueva = _construir(categoria, None, aprobados[n:], base=actual)
+        else:
+            nueva = _construir(categoria, _ESTATICOS[categoria], aprobados)
+        _categorias[categoria] = nueva
+        _aprobados_fusionados[categoria] = list(aprobados)
+        return nueva
+
+def obtener_categoria(categoria, aprobados=None):
+    """Categoría completa (estáticos + aprobados); si se pasan aprobados, se fusionan antes"""
+    if aprobados is not None:
+        return fusionar_aprobados(categoria, aprobados)
+    return _categorias[categoria]
+
+def valores(categoria, aprobados=None):
+    """Lista de valores originales de la categoría (no modificar: es compartida)"""
+    return obtener_categoria(categoria, aprobados).valores
+
+def buscar(id_item, categoria=None):
+    """Elemento por ID en O(1) (en una categoría o en todas)"""
+    if categoria is not None:
+        return _categorias[categoria].por_id.get(id_item)
+    for datos in _categorias.values():
+        elemento = datos.por_id.get(id_item)
+        if elemento is not None:
+            return elemento
+    return None
+
+def elemento_de(valor, categoria):
+    """Registro de un valor (texto o dict del mito) de la categoría, o None"""
+    return _categorias[categoria].por_id.get(id_contenido(valor))
+
+def tabla(nombre):
+    """Tabla de consulta: 'efemerides', 'dias_internacionales' o 'perlas_oscuras'"""
+    return _tablas[nombre]
+
+def recargar(mod_contenido, mod_efemerides, mod_dias):
+    """Reconstruye el catálogo con módulos de contenido recargados y lo sustituye de golpe.
+    Los aprobados ya fusionados se conservan; los IDs no cambian (dependen solo del texto)."""
+    global _ESTATICOS, _tablas, _categorias
+    estaticos = _estaticos_de(mod_contenido)
+    tablas = _tablas_de(mod_contenido, mod_efemerides, mod_dias)
+    with _lock:
+        categorias = {nombre: _construir(nombre, estaticos[nombre], _aprobados_fusionados[nombre])
+                      for nombre in CATEGORIAS}
+        _ESTATICOS, _tablas, _categorias = estaticos, tablas, categorias
+    return {nombre: len(categorias[nombre].elementos) for nombre in CATEGORIAS}
@@ -0,0 +1,71 @@
+# Codificación de los valores guardados: JSON (orjson si está instalado) + compresión opcional
+#
+# Los documentos grandes se comprimen y se guardan en base64 con un prefijo que indica
+# el formato. Los valores antiguos (JSON plano, sin prefijo) se siguen leyendo igual.
+import os
+import json
+import zlib
+import base64
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compresión: 'zlib' (por defecto), 'zstd' (requiere zstandard) o 'no'
+COMPRESION = os.environ.get('STORAGE_COMPRESION', 'zlib').lower()
+# Solo se comprimen los documentos a partir de este tamaño (bytes)
+COMPRIMIR_DESDE = int(os.environ.get('STORAGE_COMPRIMIR_DESDE', 4096))
+
+PREFIJO_ZLIB = 'z1:'
+PREFIJO_ZSTD = 'zs1:'
+
+if COMPRESION == 'zstd' and zstandard is None:
+    print("⚠️ STORAGE_COMPRESION=zstd pero zstandard no está instalado: se usa zlib")
+    COMPRESION = 'zlib'
+
+def serializar(valor):
+    """Convierte un valor en texto JSON (UTF-8 sin escapar, como ensure_ascii=False)"""
+    if orjson is not None:
+        return orjson.dumps(valor, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(valor, ensure_ascii=False, separators=(',', ':'))
+
+def deserializar(texto):
+    """Convierte texto JSON en un valor Python"""
+    if orjson is not None:
+        return orjson.loads(texto)
+    return json.loads(texto)
+
+def comprimir(texto):
+    """Texto JSON -> valor a guardar en el backend (comprimido si supera el umbral)"""
+    if COMPRESION == 'no' or len(texto) < COMPRIMIR_DESDE:
+        return texto
+    datos = texto.encode('utf-8')
+    if COMPRESION == 'zstd':
+        comprimido = zstandard.ZstdCompressor(level=3).compress(datos)
+        prefijo = PREFIJO_ZSTD
+    else:
+        comprimido = zlib.compress(datos, 6)
+        prefijo = PREFIJO_ZLIB
+    # Si no compensa (texto ya muy variado), se guarda tal cual
+    if len(comprimido) * 4 // 3 + len(prefijo) >= len(datos):
+        return texto
+    return prefijo + base64.b64encode(comprimido).decode('ascii')
+
+def descomprimir(crudo):
+    """Valor leído del backend -> texto JSON (detecta el formato por el prefijo)"""
+    if not isinstance(crudo, str):
+        return crudo
+    if crudo.startswith(PREFIJO_ZLIB):
+        return zlib.decompress(base64.b64decode(crudo[len(PREFIJO_ZLIB):])).decode('utf-8')
+    if crudo.startswith(PREFIJO_ZSTD):
+        if zstandard is None:
+            raise ValueError("Valor comprimido con zstd pero zstandard no está instalado")
+        datos = base64.b64decode(crudo[len(PREFIJO_ZSTD):])
+        return zstandard.ZstdDecompressor().decompress(datos).decode('utf-8')
+    return crudo
@@ -0,0 +1,436 @@
+# Motor de difusión: envía un mensaje a muchos chats en paralelo sin pasarse de los
+# límites de Telegram (~30 mensajes/s en total y 1 mensaje/s por chat)
+#
+# Un grupo de hilos saca envíos de una cola común. Antes de cada envío se espera a que
+# el chat pueda recibir otro mensaje y a tener un token del cubo global, así que la
+# difusión va al máximo permitido en lugar de a la latencia de cada petición HTTP.
+#
+# Las difusiones programadas se guardan además como tareas persistentes (ver abajo) para
+# que un reinicio a mitad de envío siga donde se quedó sin repetir a nadie.
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from urllib3.exceptions import ConnectTimeoutError
+import storage
+
+# Configuración (ajustable por entorno)
+HILOS = int(os.environ.get('DIFUSION_HILOS', 8))
+MENSAJES_SEGUNDO = float(os.environ.get('DIFUSION_MSG_SEGUNDO', 30))
+MENSAJES_CHAT_SEGUNDO = float(os.environ.get('DIFUSION_MSG_CHAT_SEGUNDO', 1))
+# Reintentos por envío ante 429 o errores transitorios, y espera base del backoff exponencial
+REINTENTOS = int(os.environ.get('DIFUSION_REINTENTOS', 3))
+BACKOFF_SEGUNDOS = float(os.environ.get('DIFUSION_BACKOFF_SEGUNDOS', 1))
+# Destinatarios que se reclaman de una vez (lo máximo que se pierde si el proceso muere)
+BLOQUE = max(1, int(os.environ.get('DIFUSION_BLOQUE', 10)))
+# Horas durante las que una tarea interrumpida se reanuda al arrancar
+HORAS_REANUDAR = float(os.environ.get('DIFUSION_REANUDAR_HORAS', 12))
+
+
+class CuboTokens:
+    """Limitador token bucket: 'tasa' tokens por segundo con ráfagas de hasta 'capacidad'"""
+
+    def __init__(self, tasa, capacidad=None):
+        self.tasa = tasa
+        self.capacidad = capacidad or max(1.0, tasa)
+        self.tokens = self.capacidad
+        self.ultimo = time.monotonic()
+        self.pausa_hasta = 0.0
+        self.lock = threading.Lock()
+
+    def pausar(self, segundos):
+        """Detiene la entrega de tokens (p.ej. durante el retry_after de un 429)"""
+        with self.lock:
+            self.pausa_hasta = max(self.pausa_hasta, time.monotonic() + segundos)
+            self.tokens = 0
+
+    def adquirir(self):
+        """Espera hasta conseguir un token"""
+        while True:
+            with self.lock:
+                ahora = time.monotonic()
+                if ahora < self.pausa_hasta:
+                    espera = self.pausa_hasta - ahora
+                else:
+                    desde = max(self.ultimo, self.pausa_hasta)
+                    self.tokens = min(self.capacidad, self.tokens + (ahora - desde) * self.tasa)
+                    self.ultimo = ahora
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    espera = (1 - self.tokens) / self.tasa
+            time.sleep(espera)
+
+
+class LimitadorChats:
+    """Separación mínima entre mensajes al mismo chat"""
+
+    def __init__(self, por_segundo):
+        self.intervalo = 1.0 / por_segundo
+        self.siguiente = {}  # chat_id -> primer instante (monotonic) en que puede recibir otro
+        self.lock = threading.Lock()
+
+    def reservar(self, chat_id):
+        """Reserva el siguiente hueco del chat y devuelve cuántos segundos hay que esperar"""
+        with self.lock:
+            ahora = time.monotonic()
+            if len(self.siguiente) > 50000:
+                self.siguiente = {c: t for c, t in self.siguiente.items() if t > ahora}
+            hueco = max(ahora, self.siguiente.get(chat_id, 0))
+            self.siguiente[chat_id] = hueco + self.intervalo
+            return hueco - ahora
+
+
+# Limitadores compartidos por todas las difusiones del proceso
+cubo_global = CuboTokens(MENSAJES_SEGUNDO)
+limitador_chats = LimitadorChats(MENSAJES_CHAT_SEGUNDO)
+
+# Descripciones de Telegram que indican que el chat ya no existe para el bot
+_CHAT_MUERTO = ('chat not found', 'user is deactivated', 'bot was blocked', 'bot was kicked',
+                'not a member', 'peer_id_invalid')
+
+_callbacks_inactivos = []
+
+
+def al_desactivar(funcion):
+    """Registra una función a llamar con las claves de los chats que ya no aceptan mensajes"""
+    _callbacks_inactivos.append(funcion)
+    return funcion
+
+
+def _fallo_de_conexion(error):
+    """True si el envío falló antes de llegar a Telegram (conexión rechazada, DNS o timeout al conectar).
+    Un timeout de lectura o una conexión cortada a mitad no cuentan: el mensaje pudo haberse entregado"""
+    if isinstance(error, (requests.exceptions.ConnectTimeout, ConnectionRefusedError)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        # requests envuelve el MaxRetryError de urllib3; NewConnectionError (rechazo, DNS) hereda de ConnectTimeoutError
+        motivo = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(motivo, ConnectTimeoutError)
+    return False
+
+
+def clasificar_error(error):
+    """Tipo de un error de envío: ('limite', segundos), ('inactivo', None),
+    ('transitorio', None) o ('permanente', None). Solo es transitorio lo que seguro no llegó
+    a entregarse (fallo al conectar) o lo que Telegram rechazó con un 5xx"""
+    codigo = getattr(error, 'error_code', None)
+    if codigo is None:
+        codigo = getattr(getattr(error, 'result', None), 'status_code', None)
+    descripcion = str(getattr(error, 'description', None) or error).lower()
+    if codigo == 429:
+        parametros = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+        return 'limite', float(parametros.get('retry_after', 1))
+    if codigo == 403 or any(texto in descripcion for texto in _CHAT_MUERTO):
+        return 'inactivo', None
+    if (codigo is not None and codigo >= 500) or _fallo_de_conexion(error):
+        return 'transitorio', None
+    return 'permanente', None
+
+
+def enviar_con_reintentos(enviar, chat_id, texto, opciones, resultado, lock):
+    """Un envío respetando los límites: espera el retry_after de los 429 (pausando toda la
+    difusión) y reintenta con backoff los errores transitorios.
+    Devuelve (tipo, error, segundos de la última llamada a la API)."""
+    intentos = 0
+    while True:
+        espera = limitador_chats.reservar(chat_id)
+        if espera > 0:
+            time.sleep(espera)
+        cubo_global.adquirir()
+        llamada = time.monotonic()
+        try:
+            enviar(chat_id, texto, **(opciones or {}))
+            return None, None, time.monotonic() - llamada
+        except Exception as e:
+            tipo, segundos = clasificar_error(e)
+            if tipo not in ('limite', 'transitorio') or intentos >= REINTENTOS:
+                return tipo, e, time.monotonic() - llamada
+            intentos += 1
+            with lock:
+                resultado['reintentos'] += 1
+            if tipo == 'limite':
+                print(f"⏳ Telegram pide esperar {segundos:g}s (429): se pausa la difusión")
+                cubo_global.pausar(segundos)
+            else:
+                time.sleep(BACKOFF_SEGUNDOS * 2 ** (intentos - 1) * random.uniform(0.5, 1.5))
+
+
+def resultado_vacio():
+    """Resultado de una difusión sin envíos (metricas vacío: no se guarda ninguna ejecución)"""
+    return {'total': 0, 'enviados': 0, 'errores': 0, 'reintentos': 0, 'inactivos': [],
+            'por_tipo': {}, 'primera': None, 'ultima': None, 'segundos': 0.0, 'metricas': {}}
+
+
+def difundir(envios, enviar, nombre='difusion', hilos=None, id_ejecucion=None):
+    """Envía en paralelo envíos (clave, chat_id, texto, opciones) de una lista o un iterador.
+
+    enviar(chat_id, texto, **opciones) hace el envío real (p.ej. bot.send_message).
+    Los chats que ya no existen (403, 'chat not found') se pasan a las funciones de al_desactivar().
+    Cada ejecución guarda sus métricas en 'metricas_difusion' (ver guardar_metricas).
+    Devuelve {'total', 'enviados', 'errores', 'reintentos', 'inactivos', 'por_tipo',
+    'primera', 'ultima', 'segundos', 'metricas'}."""
+    resultado = resultado_vacio()
+    if isinstance(envios, (list, tuple)) and not envios:
+        return resultado
+    inicio = time.monotonic()
+    inicio_epoch = time.time()
+    latencias = []
+    siguiente = iter(envios)
+    lock = threading.Lock()
+
+    def trabajador():
+        while True:
+            with lock:
+                envio = next(siguiente, None)
+            if envio is None:
+                return
+            clave, chat_id, texto, opciones = envio
+            tipo, error, latencia = enviar_con_reintentos(enviar, chat_id, texto, opciones, resultado, lock)
+            if error is not None:
+                print(f"Error enviando {nombre} a {clave} ({tipo}): {error}")
+            with lock:
+                if error is None:
+                    resultado['enviados'] += 1
+                    latencias.append(latencia)
+                    entregado = time.monotonic() - inicio
+                    if resultado['primera'] is None:
+                        resultado['primera'] = entregado
+                    resultado['ultima'] = entregado
+                else:
+                    resultado['errores'] += 1
+                    resultado['por_tipo'][tipo] = resultado['por_tipo'].get(tipo, 0) + 1
+                if tipo == 'inactivo':
+                    resultado['inactivos'].append(clave)
+
+    n_hilos = hilos or HILOS
+    if isinstance(envios, (list, tuple)):
+        n_hilos = min(n_hilos, len(envios))
+    with ThreadPoolExecutor(max_workers=max(1, n_hilos), thread_name_prefix=nombre) as grupo:
+        for _ in range(max(1, n_hilos)):
+            grupo.submit(trabajador)
+    resultado['total'] = resultado['enviados'] + resultado['errores']
+    resultado['segundos'] = time.monotonic() - inicio
+    if resultado['total']:
+        resultado['metricas'] = resumen_ejecucion(resultado, latencias, id_ejecucion or nombre, nombre, inicio_epoch)
+        guardar_metricas(resultado['metricas'])
+    if resultado['inactivos']:
+        for funcion in _callbacks_inactivos:
+            try:
+                funcion(resultado['inactivos'])
+            except Exception as e:
+                print(f"⚠️ Error desactivando chats ({funcion.__name__}): {e}")
+    return resultado
+
+
+# ============== MÉTRICAS ==============
+# Cada ejecución de difundir() deja un resumen en 'metricas_difusion' (las últimas
+# MAX_EJECUCIONES) para seguir la capacidad de envío según crece la base de usuarios.
+
+REDIS_METRICAS = 'metricas_difusion'
+MAX_EJECUCIONES = 50
+_metricas_lock = threading.Lock()
+
+
+def resumen_ejecucion(resultado, latencias, id_ejecucion, nombre, inicio):
+    """Métricas de una ejecución: latencia por mensaje (p50/p90/p99/máx), mensajes/s,
+    tiempo hasta la primera y la última entrega, errores por tipo y reintentos"""
+    latencias = sorted(latencias)
+    ultima = resultado['ultima']
+    return {
+        'id': id_ejecucion,
+        'nombre': nombre,
+        'inicio': inicio,
+        'segundos': round(resultado['segundos'], 3),
+        'total': resultado['total'],
+        'enviados': resultado['enviados'],
+        'errores': resultado['errores'],
+        'por_tipo': dict(resultado['por_tipo']),
+        'reintentos': resultado['reintentos'],
+        'msg_segundo': round(resultado['enviados'] / ultima, 2) if ultima else 0.0,
+        'primera': round(resultado['primera'], 3) if resultado['primera'] is not None else None,
+        'ultima': round(ultima, 3) if ultima is not None else None,
+        'latencia_ms': {
+            'p50': round(storage.percentil(latencias, 50) * 1000, 1),
+            'p90': round(storage.percentil(latencias, 90) * 1000, 1),
+            'p99': round(storage.percentil(latencias, 99) * 1000, 1),
+            'max': round(latencias[-1] * 1000, 1) if latencias else 0.0,
+        },
+    }
+
+
+def guardar_metricas(metricas):
+    """Añade las métricas de una ejecución a 'metricas_difusion' (se guardan las últimas)"""
+    with _metricas_lock:
+        storage.invalidar(REDIS_METRICAS)
+        ejecuciones = storage.obtener_lista(REDIS_METRICAS)
+        ejecuciones.append(metricas)
+        storage.guardar_lista(REDIS_METRICAS, ejecuciones[-MAX_EJECUCIONES:])
+
+
+def cargar_metricas():
+    """Métricas de las últimas ejecuciones (de la más antigua a la más reciente)"""
+    return storage.obtener_lista(REDIS_METRICAS)
+
+
+# ============== DIFUSIONES PERSISTENTES ==============
+# Cada difusión se guarda como tarea: sus envíos en lotes (difusion:{id}:{n}), un registro
+# en 'difusiones' y un contador de bloques (difusion:{id}:cursor). Antes de enviar un bloque
+# se reclama con INCR: tras un reinicio (o desde otra réplica) se sigue por el siguiente
+# bloque y nadie recibe el mensaje dos veces. La entrega es "como mucho una vez": si el
+# proceso muere a mitad de un bloque, lo que quedaba de ese bloque no se envía.
+
+REDIS_DIFUSIONES = 'difusiones'  # {id: registro de la tarea}
+PREFIJO_DIFUSION = 'difusion:'
+TAMAÑO_LOTE = 500
+DIAS_HISTORIAL = 7
+_tareas_lock = threading.Lock()
+
+
+def _clave_lote(id_tarea, n):
+    return f"{PREFIJO_DIFUSION}{id_tarea}:{n}"
+
+
+def _clave_cursor(id_tarea):
+    return f"{PREFIJO_DIFUSION}{id_tarea}:cursor"
+
+
+def cargar_tareas():
+    """Registros de las difusiones de los últimos días ({id: tarea})"""
+    return storage.obtener_dict(REDIS_DIFUSIONES)
+
+
+def actualizar_tarea(id_tarea, **cambios):
+    """Modifica el registro de una tarea (relee antes de escribir). Devuelve el registro, o None si no se guardó"""
+    with _tareas_lock:
+        storage.invalidar(REDIS_DIFUSIONES)
+        tareas = storage.obtener_dict(REDIS_DIFUSIONES)
+        tarea = dict(tareas.get(id_tarea, {}), **cambios)
+        tareas[id_tarea] = tarea
+        limite = time.time() - DIAS_HISTORIAL * 86400
+        tareas = {k: v for k, v in tareas.items() if v.get('creada', 0) >= limite}
+        return tarea if storage.guardar(REDIS_DIFUSIONES, tareas) else None
+
+
+def crear_tarea(id_tarea, envios, nombre='difusion', estado='en_curso'):
+    """Guarda los envíos de una difusión como tarea. Devuelve el registro, o None si no se pudo guardar.
+    Las opciones de cada envío deben ser serializables (reply_markup como JSON).
+    Con estado='preparada' queda guardada sin enviar hasta que se llame a difundir_tarea()."""
+    envios = [list(envio) for envio in envios]
+    lotes = {_clave_lote(id_tarea, i // TAMAÑO_LOTE): envios[i:i + TAMAÑO_LOTE]
+             for i in range(0, len(envios), TAMAÑO_LOTE)}
+    if lotes and not storage.guardar_muchos(lotes, cachear=False):
+        return None
+    return actualizar_tarea(id_tarea, id=id_tarea, nombre=nombre, total=len(envios),
+                            lotes=len(lotes), estado=estado, creada=time.time(),
+                            enviados=0, errores=0)
+
+
+def _limpiar_tarea(tarea):
+    """Borra los lotes de una tarea que ya no se va a enviar. El contador se deja (caduca solo):
+    si una réplica con el registro antiguo en caché la retoma, no vuelve a empezar desde cero"""
+    for n in range(tarea.get('lotes', 0)):
+        storage.borrar(_clave_lote(tarea['id'], n))
+
+
+def _reclamados(tarea, fin):
+    """Iterador de los envíos pendientes de una tarea, reclamando bloques con INCR.
+    Al agotar la tarea marca fin['completa']; si no se puede reclamar, se detiene."""
+    id_tarea, total = tarea['id'], tarea['total']
+    lote_actual = (None, [])
+    while True:
+        bloque = storage.incrementar(_clave_cursor(id_tarea), expira_en=time.time() + 2 * 86400)
+        if not bloque:
+            print(f"⚠️ No se pudo reclamar un bloque de la difusión {id_tarea}: se detiene")
+            return
+        inicio = (bloque - 1) * BLOQUE
+        if inicio >= total:
+            fin['completa'] = True
+            return
+        for i in range(inicio, min(inicio + BLOQUE, total)):
+            n = i // TAMAÑO_LOTE
+            if lote_actual[0] != n:
+                clave = _clave_lote(id_tarea, n)
+                lote_actual = (n, storage.obtener_muchos([clave], [], cachear=False)[clave])
+            envios = lote_actual[1]
+            if i % TAMAÑO_LOTE < len(envios):
+                yield envios[i % TAMAÑO_LOTE]
+
+
+def ejecutar_tarea(id_tarea, enviar):
+    """Envía lo que quede de una tarea guardada. Devuelve el resultado de esta ejecución"""
+    storage.invalidar(REDIS_DIFUSIONES)
+    tarea = cargar_tareas().get(id_tarea)
+    if not tarea or tarea.get('estado') != 'en_curso':
+        return resultado_vacio()
+    fin = {'completa': False}
+    resultado = difundir(_reclamados(tarea, fin), enviar, tarea.get('nombre', 'difusion'), id_ejecucion=id_tarea)
+    cambios = {
+        'enviados': tarea.get('enviados', 0) + resultado['enviados'],
+        'errores': tarea.get('errores', 0) + resultado['errores'],
+        'reintentos': tarea.get('reintentos', 0) + resultado['reintentos'],
+        'inactivos': tarea.get('inactivos', 0) + len(resultado['inactivos']),
+    }
+    if fin['completa']:
+        cambios.update(estado='terminada', terminada=time.time())
+    actualizar_tarea(id_tarea, **cambios)
+    if fin['completa']:
+        _limpiar_tarea(tarea)
+    return resultado
+
+
+def difundir_tarea(id_tarea, preparar, enviar, nombre='difusion'):
+    """Difusión persistente e idempotente: la primera vez llama a preparar() para obtener los
+    envíos y los guarda como tarea; si la tarea ya existe, solo envía lo que falte."""
+    storage.invalidar(REDIS_DIFUSIONES)
+    tarea = cargar_tareas().get(id_tarea)
+    if tarea is None:
+        envios = preparar()
+        if not envios:
+            return resultado_vacio()
+        tarea = crear_tarea(id_tarea, envios, nombre)
+        if tarea is None:
+            print(f"⚠️ No se pudo guardar la difusión {id_tarea}: se envía sin puntos de control")
+            return difundir(envios, enviar, nombre, id_ejecucion=id_tarea)
+    elif tarea.get('estado') == 'preparada':
+        actualizar_tarea(id_tarea, estado='en_curso', iniciada=time.time())
+    elif tarea.get('estado') == 'en_curso':
+        print(f"↩️ Reanudando difusión {id_tarea}")
+    return ejecutar_tarea(id_tarea, enviar)
+
+
+def preparar_tarea(id_tarea, preparar, nombre='difusion'):
+    """Genera y guarda los envíos de una difusión sin enviarlos (estado 'preparada'), para que
+    difundir_tarea() solo tenga que enviar. Devuelve el registro, o None si no hay nada que enviar."""
+    storage.invalidar(REDIS_DIFUSIONES)
+    tarea = cargar_tareas().get(id_tarea)
+    if tarea is not None:
+        return tarea
+    envios = preparar()
+    if not envios:
+        return None
+    return crear_tarea(id_tarea, envios, nombre, estado='preparada')
+
+
+def reanudar_pendientes(enviar):
+    """Sigue las tareas que un reinicio dejó a medias (las más antiguas se abandonan).
+    Las preparadas esperan a su hora; solo se limpian si nadie las ha enviado a tiempo."""
+    storage.invalidar(REDIS_DIFUSIONES)
+    limite = time.time() - HORAS_REANUDAR * 3600
+    for id_tarea, tarea in cargar_tareas().items():
+        if tarea.get('estado') == 'preparada' and tarea.get('creada', 0) < limite:
+            actualizar_tarea(id_tarea, estado='abandonada')
+            _limpiar_tarea(tarea)
+            continue
+        if tarea.get('estado') != 'en_curso':
+            continue
+        if tarea.get('creada', 0) < limite:
+            actualizar_tarea(id_tarea, estado='abandonada')
+            _limpiar_tarea(tarea)
+            print(f"🗑️ Difusión {id_tarea} abandonada (demasiado antigua para reanudar)")
+            continue
+        print(f"↩️ Reanudando difusión {id_tarea}")
+        resultado = ejecutar_tarea(id_tarea, enviar)
+        print(f"✅ Difusión {id_tarea} reanudada: {resultado['enviados']} OK, {resultado['errores']} errores")
@@ -1,5 +1,6 @@
 # Horóscopo irónico - Predicciones absurdas
 import random
+import hashlib
 from datetime import datetime
 
 SIGNOS = {
@@ -191,17 +192,22 @@ PREDICCIONES_SIGNO = {
     ],
 }
 
-def obtener_horoscopo(signo):
-    """Genera un horóscopo irónico para un signo (consistente por día)"""
+def normalizar_signo(signo):
+    """Nombre del signo en minúsculas y sin tildes (geminis, cancer)"""
     signo = signo.lower().strip()
-    signo = signo.replace("é", "e").replace("á", "a")  # geminis, cancer
+    return signo.replace("é", "e").replace("á", "a")
+
+def obtener_horoscopo(signo, fecha_hoy=None):
+    """Genera un horóscopo irónico para un signo (consistente por día)"""
+    signo = normalizar_signo(signo)
     
     if signo not in SIGNOS:
         return None, None
     
     # Crear semilla determinista: fecha + signo = misma predicción todo el día
-    fecha_hoy = datetime.now().strftime("%Y-%m-%d")
-    semilla = hash(f"{fecha_hoy}_{signo}") % (2**32)
+    # (md5 y no hash(): hash() de un str cambia en cada proceso y entre réplicas)
+    fecha_hoy = fecha_hoy or datetime.now().strftime("%Y-%m-%d")
+    semilla = int(hashlib.md5(f"{fecha_hoy}_{signo}".encode()).hexdigest(), 16) % (2**32)
     rng = random.Random(semilla)
     
     # 30% probabilidad de predicción específica del signo
@@ -212,6 +218,10 @@ def obtener_horoscopo(signo):
     
     return SIGNOS[signo], prediccion
 
+def predicciones_del_dia(fecha_hoy):
+    """Predicción de cada signo para una fecha ({signo: predicción})"""
+    return {signo: obtener_horoscopo(signo, fecha_hoy)[1] for signo in SIGNOS}
+
 def listar_signos():
     """Devuelve la lista de signos disponibles"""
     return list(SIGNOS.keys())
@@ -0,0 +1,90 @@
+# Renderizado del mensaje diario por segmentos cacheados
+#
+# El mensaje se compone de una cabecera fija, un bloque por cada contenido elegido
+# (palabra, refrán, frase) y una cola común a todos (mito, día internacional, efeméride
+# y fecha). Cada bloque se renderiza y escapa una sola vez: por elemento de contenido
+# los bloques personales y por día la cola. Cada mensaje es solo una concatenación.
+import threading
+
+CABECERA = "\n🦪 *PERLA DEL DÍA*\n\n"
+
+TITULOS = {
+    'palabras': "📚 *Palabra curiosa:*",
+    'refranes': "🎯 *Refrán:*",
+    'frases': "😂 *Frase mítica:*",
+}
+
+# Caracteres con significado en el Markdown clásico de Telegram (parse_mode='Markdown')
+_ESPECIALES = ('_', '*', '`', '[')
+
+# categoria -> {texto del elemento -> bloque renderizado}. Se indexa por el texto (del que
+# sale su ID estable) para no recalcular el ID en cada mensaje
+_segmentos = {categoria: {} for categoria in TITULOS}
+_colas = {}  # fecha -> cola común renderizada
+_lock = threading.Lock()
+
+# Límite de colas guardadas (una por día; se guardan pocas por si conviven dos fechas)
+MAX_COLAS = 4
+
+
+def escapar(texto):
+    """Escapa texto fuera de entidades para parse_mode='Markdown'"""
+    texto = str(texto)
+    for c in _ESPECIALES:
+        texto = texto.replace(c, '\\' + c)
+    return texto
+
+
+def escapar_cursiva(texto):
+    """Texto dentro de _cursiva_: los '_' cierran la entidad, se escapan y se vuelve a abrir"""
+    return str(texto).replace('_', '_\\__')
+
+
+def segmento(categoria, valor):
+    """Bloque '<título>\\n<contenido>\\n\\n' de un elemento, renderizado una sola vez"""
+    cache = _segmentos[categoria]
+    texto = cache.get(valor)
+    if texto is None:
+        texto = f"{TITULOS[categoria]}\n{escapar(valor)}\n\n"
+        with _lock:
+            cache[valor] = texto
+    return texto
+
+
+def cola(contexto):
+    """Parte común del mensaje del día (mito, día internacional, efeméride y fecha)"""
+    fecha = contexto['fecha']
+    texto = _colas.get(fecha)
+    if texto is not None:
+        return texto
+    mito = contexto['mito']
+    texto = f"🔍 *Mito desmontado:*\n❌ _{escapar_cursiva(mito['mito'])}_\n✅ {escapar(mito['realidad'])}\n"
+    if contexto.get('dia_internacional'):
+        texto += f"\n🌐 *Hoy se celebra:*\n{escapar(contexto['dia_internacional'])}\n"
+    if contexto.get('efemeride'):
+        texto += f"\n📅 *Tal día como hoy:*\n{escapar(contexto['efemeride'])}\n"
+    texto += f"\n_{contexto['fecha_texto']}_"
+    with _lock:
+        if len(_colas) >= MAX_COLAS:
+            _colas.clear()
+        _colas[fecha] = texto
+    return texto
+
+
+def mensaje_diario(palabra, refran, frase, contexto):
+    """Mensaje del día completo a partir de los segmentos cacheados"""
+    return ''.join((CABECERA, segmento('palabras', palabra), segmento('refranes', refran),
+                    segmento('frases', frase), cola(contexto)))
+
+
+def limpiar():
+    """Vacía las cachés (al recargar el contenido)"""
+    with _lock:
+        for cache in _segmentos.values():
+            cache.clear()
+        _colas.clear()
+
+
+def estadisticas():
+    """Número de segmentos y colas en caché"""
+    return {'segmentos': sum(len(cache) for cache in _segmentos.values()), 'colas': len(_colas)}
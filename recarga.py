@@ -0,0 +1,96 @@
+# Recarga en caliente del contenido (contenido.py, efemerides.py, dias_internacionales.py)
+#
+# Un hilo revisa cada pocos segundos la fecha de modificación de los módulos. Si alguno
+# cambia, los vuelve a importar en segundo plano, reconstruye el catálogo y lo sustituye
+# de golpe: los envíos en curso siguen con el catálogo anterior y los IDs no cambian.
+# Si el fichero nuevo tiene errores, se avisa y se sigue con el contenido anterior.
+import os
+import sys
+import time
+import importlib
+import threading
+import catalogo
+
+MODULOS = catalogo.MODULOS_CONTENIDO
+# Segundos entre comprobaciones (0 desactiva la recarga)
+INTERVALO = float(os.environ.get('CONTENIDO_RECARGA_SEGUNDOS', 30))
+
+_callbacks = []
+_hilo = None
+_fechas = {}
+
+
+def al_recargar(funcion):
+    """Registra una función a llamar tras cada recarga (p.ej. invalidar cachés)"""
+    _callbacks.append(funcion)
+    return funcion
+
+
+def _fecha_modificacion(nombre):
+    try:
+        return os.stat(catalogo.ruta_fuente(nombre)).st_mtime
+    except OSError:
+        return None
+
+
+def _importar(nombre):
+    """Vuelve a importar un módulo (o lo importa por primera vez si el catálogo vino del snapshot)"""
+    if nombre in sys.modules:
+        return importlib.reload(sys.modules[nombre])
+    return importlib.import_module(nombre)
+
+
+def _validar(mod_contenido, mod_efemerides, mod_dias):
+    """Comprueba que los módulos recargados tienen lo que espera el catálogo"""
+    for nombre in ('PALABRAS_CURIOSAS', 'REFRANES', 'FRASES_AMIGOS', 'MITOS_DESMONTADOS', 'PERLAS_OSCURAS'):
+        valor = getattr(mod_contenido, nombre, None)
+        if not isinstance(valor, list) or not valor:
+            raise ValueError(f"contenido.{nombre} debe ser una lista no vacía")
+    if not all(catalogo.mito_valido(m) for m in mod_contenido.MITOS_DESMONTADOS):
+        raise ValueError("contenido.MITOS_DESMONTADOS: cada mito necesita 'mito' y 'realidad'")
+    if not isinstance(getattr(mod_efemerides, 'EFEMERIDES', None), dict):
+        raise ValueError("efemerides.EFEMERIDES debe ser un diccionario")
+    if not isinstance(getattr(mod_dias, 'DIAS_INTERNACIONALES', None), dict):
+        raise ValueError("dias_internacionales.DIAS_INTERNACIONALES debe ser un diccionario")
+
+
+def recargar():
+    """Vuelve a importar los módulos de contenido y sustituye el catálogo. Devuelve los totales
+    por categoría, o None si los ficheros nuevos no son válidos (se mantiene el contenido anterior)."""
+    inicio = time.perf_counter()
+    try:
+        modulos = [_importar(nombre) for nombre in MODULOS]
+        _validar(*modulos)
+    except Exception as e:
+        print(f"⚠️ Recarga de contenido descartada: {e}")
+        return None
+    totales = catalogo.recargar(*modulos)
+    for funcion in _callbacks:
+        try:
+            funcion()
+        except Exception as e:
+            print(f"⚠️ Error tras recargar el contenido ({funcion.__name__}): {e}")
+    duracion = (time.perf_counter() - inicio) * 1000
+    print(f"♻️ Contenido recargado en {duracion:.0f} ms: "
+          + ", ".join(f"{n} {nombre}" for nombre, n in totales.items()))
+    return totales
+
+
+def _bucle():
+    while True:
+        time.sleep(INTERVALO)
+        fechas = {nombre: _fecha_modificacion(nombre) for nombre in MODULOS}
+        if fechas != _fechas:
+            _fechas.update(fechas)
+            recargar()
+
+
+def iniciar():
+    """Arranca el hilo que vigila los ficheros de contenido (una sola vez)"""
+    global _hilo
+    if INTERVALO <= 0 or _hilo is not None:
+        return
+    _fechas.update({nombre: _fecha_modificacion(nombre) for nombre in MODULOS})
+    _hilo = threading.Thread(target=_bucle, daemon=True, name='recarga-contenido')
+    _hilo.start()
+    print(f"👀 Recarga de contenido activa (cada {INTERVALO:g} s)")
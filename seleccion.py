@@ -0,0 +1,179 @@
+# Estrategias de selección de contenido sin repetición
+#
+# Modo 'lista' (por defecto): el historial guarda los IDs ya enviados y se elige al azar
+# entre los que faltan (lo hace bot.obtener_sin_repetir).
+# Modo 'cursor': cada usuario guarda solo una semilla y una posición por categoría.
+# La semilla define una permutación pseudoaleatoria de los índices del catálogo y la
+# posición avanza una casilla por envío: O(1) por elección y estado constante por usuario.
+# Modo 'bitset': cada usuario guarda un mapa de bits por categoría (1 bit por elemento del
+# catálogo, ~50 bytes para 400 elementos) y se elige al azar entre los bits a cero.
+# En ambos modos la posición de cada elemento la fija un registro de IDs que solo crece
+# (bot.orden_seleccion): añadir o quitar contenido no mueve a los demás elementos.
+import os
+import math
+import base64
+import random
+import hashlib
+from functools import lru_cache
+
+MODOS = ('lista', 'cursor', 'bitset')
+MODO = os.environ.get('MODO_SELECCION', 'lista').lower()
+
+if MODO not in MODOS:
+    print(f"⚠️ MODO_SELECCION={MODO} desconocido: se usa 'lista'")
+    MODO = 'lista'
+
+
+# Rondas de la red de Feistel que define la permutación
+RONDAS = 4
+# Versión de la función de ronda guardada en cada cursor ('v'). Los cursores sin versión
+# (1) usan la anterior, basada en hash() de tuplas, hasta que terminan su vuelta
+VERSION_CURSOR = 2
+
+
+@lru_cache(maxsize=4096)
+def _claves(semilla):
+    """Claves de ronda derivadas de la semilla"""
+    rng = random.Random(semilla)
+    return tuple(rng.getrandbits(32) for _ in range(RONDAS))
+
+
+def _ronda(clave, der):
+    """Función de ronda: blake2b de (clave, mitad derecha), igual en cualquier versión de Python"""
+    datos = clave.to_bytes(4, 'big') + der.to_bytes(8, 'big')
+    return int.from_bytes(hashlib.blake2b(datos, digest_size=8).digest(), 'big')
+
+
+def _ronda_v1(clave, der):
+    """Función de ronda de los cursores antiguos (hash() de tuplas: depende de la versión de Python)"""
+    return hash((clave, der))
+
+
+def _feistel(x, claves, mitad_bits, ronda=_ronda):
+    """Biyección sobre enteros de 2*mitad_bits bits"""
+    mascara = (1 << mitad_bits) - 1
+    izq, der = x >> mitad_bits, x & mascara
+    for clave in claves:
+        izq, der = der, izq ^ (ronda(clave, der) & mascara)
+    return (izq << mitad_bits) | der
+
+
+def indice_en(cursor, posicion):
+    """Índice del catálogo que ocupa una posición de la permutación del cursor"""
+    total = cursor['total']
+    if posicion >= total:
+        # Elementos añadidos después de empezar la vuelta: van al final, en orden
+        return posicion
+    if total == 1:
+        return 0
+    # Permutación sobre 2^(2*mitad_bits) >= total; los valores fuera de rango se vuelven
+    # a permutar (cycle walking) hasta caer dentro
+    mitad_bits = max(1, math.ceil(math.log2(total) / 2))
+    claves = _claves(cursor['semilla'])
+    ronda = _ronda if cursor.get('v', 1) >= 2 else _ronda_v1
+    indice = _feistel(posicion, claves, mitad_bits, ronda)
+    while indice >= total:
+        indice = _feistel(indice, claves, mitad_bits, ronda)
+    return indice
+
+
+def siguiente(n, cursor=None, semilla=None):
+    """Siguiente índice (0..n-1) de un cursor; devuelve (índice, cursor actualizado).
+    Al completar la vuelta se baraja de nuevo con otra semilla (o la indicada)."""
+    if n <= 0:
+        raise ValueError("No hay contenido para elegir")
+    if not cursor or cursor.get('pos', 0) >= n or cursor.get('total', 0) > n:
+        cursor = {
+            'semilla': semilla if semilla is not None else random.getrandbits(32),
+            'pos': 0,
+            'total': n,
+            'v': VERSION_CURSOR,
+        }
+    indice = indice_en(cursor, cursor['pos'])
+    cursor = dict(cursor, pos=cursor['pos'] + 1)
+    return indice, cursor
+
+
+def vistos(cursor):
+    """Elementos ya enviados en la vuelta actual"""
+    return (cursor or {}).get('pos', 0)
+
+
+# ============== BITSET ==============
+
+# Bits a 1 de cada valor de byte (para contar y saltar bytes enteros)
+_UNOS = bytes(bin(i).count('1') for i in range(256))
+
+
+def bits_desde_texto(texto):
+    """Mapa de bits guardado (base64) -> bytearray"""
+    return bytearray(base64.b64decode(texto)) if texto else bytearray()
+
+
+def bits_a_texto(bits):
+    """bytearray -> texto base64 para guardar en el historial"""
+    return base64.b64encode(bytes(bits)).decode('ascii')
+
+
+def contar_bits(bits, n=None):
+    """Elementos marcados (solo los n primeros si se indica)"""
+    if n is not None:
+        bits = bits[:(n + 7) // 8]
+        extra = len(bits) * 8 - n
+        if extra > 0 and bits:
+            bits = bits[:-1] + bytes([bits[-1] & (0xFF >> extra)])
+    return sum(_UNOS[b] for b in bits)
+
+
+def _k_esimo_libre(bits, n, k):
+    """Índice del k-ésimo elemento no visto (0..n-1), saltando bytes llenos de golpe"""
+    for posicion in range((n + 7) // 8):
+        byte = bits[posicion] if posicion < len(bits) else 0
+        libres = 8 - _UNOS[byte]
+        if k >= libres:
+            k -= libres
+            continue
+        for bit in range(8):
+            if not byte & (1 << bit):
+                if k == 0:
+                    return posicion * 8 + bit
+                k -= 1
+    return None
+
+
+def mascara(n, ausentes):
+    """Mapa de bits con las posiciones indicadas a 1 (elementos que ya no están en el catálogo)"""
+    bits = bytearray((n + 7) // 8)
+    for indice in ausentes:
+        bits[indice // 8] |= 1 << (indice % 8)
+    return bytes(bits)
+
+
+def _con_mascara(bits, ocupados):
+    """OR de un mapa con la máscara de ausentes (sin modificar el mapa guardado)"""
+    if not ocupados:
+        return bits
+    return bytearray(a | b for a, b in zip(bits.ljust(len(ocupados), b'\0'), ocupados)) + bits[len(ocupados):]
+
+
+def siguiente_bitset(n, texto=None, rng=random, ocupados=None):
+    """Elige al azar un índice no visto (0..n-1); devuelve (índice, mapa actualizado en base64).
+    'ocupados' es una máscara (ver mascara()) de posiciones que no se pueden elegir.
+    Cuando se han visto todos, el mapa se vacía y empieza otra vuelta."""
+    if n <= 0:
+        raise ValueError("No hay contenido para elegir")
+    bits = bits_desde_texto(texto)
+    efectivos = _con_mascara(bits, ocupados)
+    libres = n - contar_bits(efectivos, n)
+    if libres <= 0:
+        bits = bytearray()
+        efectivos = _con_mascara(bits, ocupados)
+        libres = n - contar_bits(efectivos, n)
+        if libres <= 0:
+            raise ValueError("No hay contenido para elegir")
+    indice = _k_esimo_libre(efectivos, n, rng.randrange(libres))
+    byte = indice // 8
+    if len(bits) <= byte:
+        bits.extend(bytes(byte + 1 - len(bits)))
+    bits[byte] |= 1 << (indice % 8)
+    return indice, bits_a_texto(bits)
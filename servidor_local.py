@@ -0,0 +1,268 @@
+# Servidor local que imita Upstash Redis (API REST) y la API de bots de Telegram
+#
+# Sirve para probar el bot entero sin red ni cuentas reales, con latencia configurable:
+#
+#   python servidor_local.py --latencia-ms 40 --sembrar-usuarios 5000
+#   UPSTASH_REDIS_REST_URL=http://127.0.0.1:8079 UPSTASH_REDIS_REST_TOKEN=local \
+#   TELEGRAM_API_URL=http://127.0.0.1:8079 TOKEN=123:local CHAT_ID=1 python bot.py
+#
+# Redis: POST / con el comando como lista JSON (["SET", "clave", "valor"]), POST /pipeline y
+# POST /multi-exec (transacción: los comandos se ejecutan sin intercalarse con otros).
+# Telegram: /bot<token>/<método>; sendMessage y compañía responden como la API real.
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from backends import BackendMemoria
+
+datos = BackendMemoria()
+# Reentrante: /multi-exec lo retiene mientras cada comando lo vuelve a tomar
+datos.lock = threading.RLock()
+
+# Contadores de lo recibido (se imprimen cada minuto y en GET /stats)
+estadisticas = {'redis': 0, 'telegram': 0, 'mensajes': 0}
+_estadisticas_lock = threading.Lock()
+_mensaje_id = [0]
+
+
+def _contar(campo, n=1):
+    with _estadisticas_lock:
+        estadisticas[campo] += n
+
+
+# ============== REDIS ==============
+
+def ejecutar_comando(comando):
+    """Ejecuta un comando Redis sobre el backend en memoria -> (resultado, error)"""
+    if not comando:
+        return None, 'ERR empty command'
+    nombre = str(comando[0]).upper()
+    args = [str(a) for a in comando[1:]]
+    try:
+        if nombre == 'PING':
+            return 'PONG', None
+        if nombre == 'GET':
+            return datos.get(args[0]), None
+        if nombre == 'SET':
+            # Opciones (EX, NX...) no se usan en el bot: se ignoran
+            return datos.set(args[0], args[1]), None
+        if nombre == 'MGET':
+            return datos.mget(*args), None
+        if nombre == 'MSET':
+            datos.mset(dict(zip(args[0::2], args[1::2])))
+            return 'OK', None
+        if nombre == 'INCR':
+            return datos.incr(args[0]), None
+        if nombre == 'EXPIREAT':
+            return datos.expireat(args[0], int(args[1])), None
+        if nombre == 'DEL':
+            return datos.delete(*args), None
+        if nombre == 'EXISTS':
+            return sum(1 for v in datos.mget(*args) if v is not None), None
+        if nombre == 'DBSIZE':
+            return sum(1 for v in datos.mget(*list(datos.datos)) if v is not None), None
+        if nombre in ('FLUSHALL', 'FLUSHDB'):
+            with datos.lock:
+                datos.datos.clear()
+                datos.expiraciones.clear()
+            return 'OK', None
+    except (IndexError, ValueError) as e:
+        return None, f"ERR {nombre}: {e}"
+    return None, f"ERR unknown command '{nombre}'"
+
+
+def codificar(valor):
+    """Codifica en base64 las cadenas de la respuesta (cabecera Upstash-Encoding: base64)"""
+    if isinstance(valor, str):
+        return valor if valor == 'OK' else base64.b64encode(valor.encode('utf-8')).decode('ascii')
+    if isinstance(valor, list):
+        return [codificar(v) for v in valor]
+    return valor
+
+
+# ============== TELEGRAM ==============
+
+def _nuevo_mensaje(chat_id, texto):
+    with _estadisticas_lock:
+        _mensaje_id[0] += 1
+        mensaje_id = _mensaje_id[0]
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        pass
+    return {
+        'message_id': mensaje_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Prueba'},
+        'from': {'id': 1, 'is_bot': True, 'first_name': 'Perla local', 'username': 'perla_local_bot'},
+        'text': texto or '',
+    }
+
+
+def metodo_telegram(metodo, params):
+    """Respuesta mínima compatible con la API de bots para cada método"""
+    metodo = metodo.lower()
+    if metodo == 'getme':
+        return {'id': 1, 'is_bot': True, 'first_name': 'Perla local', 'username': 'perla_local_bot',
+                'can_join_groups': True, 'can_read_all_group_messages': False,
+                'supports_inline_queries': False}
+    if metodo == 'getupdates':
+        # Long polling: nunca llegan mensajes, se espera un poco para no girar en vacío
+        time.sleep(min(float(params.get('timeout') or 0), 1.0))
+        return []
+    if metodo in ('sendmessage', 'sendphoto', 'senddocument', 'sendpoll', 'editmessagetext'):
+        _contar('mensajes')
+        return _nuevo_mensaje(params.get('chat_id'), params.get('text') or params.get('caption'))
+    return True
+
+
+# ============== HTTP ==============
+
+class Manejador(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, como Upstash y Telegram
+    disable_nagle_algorithm = True  # cabeceras y cuerpo van en escrituras separadas
+    latencia = 0.0
+    jitter = 0.0
+    token = None
+
+    def _esperar(self):
+        if self.latencia or self.jitter:
+            time.sleep(max(0, self.latencia + random.uniform(-self.jitter, self.jitter)))
+
+    def _responder(self, codigo, cuerpo):
+        datos_respuesta = json.dumps(cuerpo, ensure_ascii=False).encode('utf-8')
+        self.send_response(codigo)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(datos_respuesta)))
+        self.end_headers()
+        self.wfile.write(datos_respuesta)
+
+    def _leer_cuerpo(self):
+        longitud = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(longitud) if longitud else b''
+
+    def _params(self, ruta):
+        """Parámetros de Telegram: query string + cuerpo (formulario o JSON)"""
+        params = {k: v[0] for k, v in parse_qs(ruta.query).items()}
+        cuerpo = self._leer_cuerpo()
+        if cuerpo:
+            tipo = self.headers.get('Content-Type', '')
+            if 'json' in tipo:
+                params.update(json.loads(cuerpo))
+            elif 'form-urlencoded' in tipo:
+                params.update({k: v[0] for k, v in parse_qs(cuerpo.decode('utf-8')).items()})
+        return params
+
+    def do_GET(self):
+        ruta = urlparse(self.path)
+        if ruta.path.startswith('/bot'):
+            self._telegram(ruta)
+        elif ruta.path == '/stats':
+            self._responder(200, estadisticas)
+        else:
+            self._leer_cuerpo()
+            self._responder(404, {'error': 'not found'})
+
+    def do_POST(self):
+        ruta = urlparse(self.path)
+        if ruta.path.startswith('/bot'):
+            self._telegram(ruta)
+        else:
+            self._redis(ruta)
+
+    def _telegram(self, ruta):
+        params = self._params(ruta)
+        self._esperar()
+        _contar('telegram')
+        metodo = ruta.path.rstrip('/').rsplit('/', 1)[-1]
+        self._responder(200, {'ok': True, 'result': metodo_telegram(metodo, params)})
+
+    def _redis(self, ruta):
+        cuerpo = self._leer_cuerpo()
+        if self.token and self.headers.get('Authorization') != f"Bearer {self.token}":
+            self._responder(401, {'error': 'Unauthorized'})
+            return
+        try:
+            peticion = json.loads(cuerpo or b'null')
+        except ValueError:
+            self._responder(400, {'error': 'ERR invalid JSON'})
+            return
+        self._esperar()
+        base64_activo = self.headers.get('Upstash-Encoding') == 'base64'
+
+        def respuesta(comando):
+            resultado, error = ejecutar_comando(comando)
+            if error:
+                return {'error': error}
+            return {'result': codificar(resultado) if base64_activo else resultado}
+
+        if ruta.path.rstrip('/') == '/pipeline':
+            _contar('redis', len(peticion or []))
+            self._responder(200, [respuesta(c) for c in peticion or []])
+            return
+        if ruta.path.rstrip('/') == '/multi-exec':
+            _contar('redis', len(peticion or []))
+            with datos.lock:
+                respuestas = [respuesta(c) for c in peticion or []]
+            self._responder(200, respuestas)
+            return
+        _contar('redis')
+        cuerpo_respuesta = respuesta(peticion)
+        self._responder(400 if 'error' in cuerpo_respuesta else 200, cuerpo_respuesta)
+
+    def log_message(self, format, *args):
+        pass  # Silenciar logs HTTP
+
+
+def sembrar_usuarios(n):
+    """Crea N usuarios ficticios en 'usuarios' para simular una base grande"""
+    ahora = time.strftime('%Y-%m-%d %H:%M')
+    usuarios = {
+        str(100000 + i): {'nombre': f'Usuario {i}', 'username': f'usuario{i}', 'chat_id': 100000 + i,
+                          'ultima_vez': ahora}
+        for i in range(n)
+    }
+    datos.set('usuarios', json.dumps(usuarios, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upstash Redis + API de Telegram simulados en local')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--puerto', type=int, default=8079)
+    parser.add_argument('--token', default=None, help='Token Bearer exigido en Redis (por defecto, ninguno)')
+    parser.add_argument('--latencia-ms', type=float, default=0, help='Latencia añadida a cada petición')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Variación aleatoria de la latencia (±)')
+    parser.add_argument('--sembrar-usuarios', type=int, default=0, help='Número de usuarios ficticios')
+    args = parser.parse_args()
+
+    Manejador.latencia = args.latencia_ms / 1000
+    Manejador.jitter = args.jitter_ms / 1000
+    Manejador.token = args.token
+    if args.sembrar_usuarios:
+        sembrar_usuarios(args.sembrar_usuarios)
+        print(f"👥 {args.sembrar_usuarios} usuarios ficticios creados")
+
+    servidor = ThreadingHTTPServer((args.host, args.puerto), Manejador)
+    servidor.daemon_threads = True
+    print(f"🧪 Servidor local en http://{args.host}:{args.puerto} "
+          f"(latencia {args.latencia_ms:g} ms ± {args.jitter_ms:g} ms)")
+
+    def informar():
+        while True:
+            time.sleep(60)
+            print(f"📊 Redis: {estadisticas['redis']} comandos · Telegram: {estadisticas['telegram']} "
+                  f"llamadas · {estadisticas['mensajes']} mensajes")
+
+    threading.Thread(target=informar, daemon=True).start()
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
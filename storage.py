@@ -1,47 +1,492 @@
-# Módulo de almacenamiento persistente con Upstash Redis
+# Módulo de almacenamiento persistente (Upstash Redis, SQLite local o memoria)
 import os
-import json
-from upstash_redis import Redis
+import re
+import sys
+import time
+import atexit
+import threading
+from collections import OrderedDict, deque
+import backends
+import codec
 
 # Configuración de Redis
 REDIS_URL = os.environ.get('UPSTASH_REDIS_REST_URL')
 REDIS_TOKEN = os.environ.get('UPSTASH_REDIS_REST_TOKEN')
 
-# Cliente Redis (None si no hay credenciales)
-redis_client = None
-if REDIS_URL and REDIS_TOKEN:
+# Backend elegido: upstash, sqlite o memoria (por defecto Upstash si hay credenciales)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or ('upstash' if REDIS_URL and REDIS_TOKEN else 'sqlite')
+
+# Configuración de la caché en memoria (TTL en segundos, 0 = desactivada)
+CACHE_TTL = float(os.environ.get('STORAGE_CACHE_TTL', 60))
+CACHE_MAX_CLAVES = int(os.environ.get('STORAGE_CACHE_MAX_CLAVES', 256))
+
+# Máximo de claves por petición MGET
+LOTE_MAX = 500
+
+# Valor de obtener_muchos(..., marcar_fallos=True) para las claves que no se pudieron leer
+# (fallo del backend, no clave inexistente): quien lo recibe no debe reescribir esa clave
+FALLO_LECTURA = object()
+
+# Escritura diferida (write-behind), opcional: "clave:segundos,..." p.ej. "usuarios:30,votos:5".
+# Cada clave (o familia, como estado:#) indica cuántos segundos puede esperar en memoria antes de
+# llegar al backend; las escrituras repetidas dentro de ese plazo se agrupan en una sola.
+def _parsear_diferidas(texto):
+    """Convierte 'usuarios:30,votos:5' en {'usuarios': 30.0, 'votos': 5.0}"""
+    diferidas = {}
+    for parte in filter(None, (p.strip() for p in texto.split(','))):
+        clave, _, segundos = parte.rpartition(':')
+        diferidas[clave] = float(segundos)
+    return diferidas
+
+CLAVES_DIFERIDAS = _parsear_diferidas(os.environ.get('STORAGE_DIFERIDO', ''))
+
+# Métricas por clave y por handler (STORAGE_METRICAS=0 las desactiva)
+METRICAS_ACTIVAS = os.environ.get('STORAGE_METRICAS', '1') != '0'
+MUESTRAS_LATENCIA = 500  # últimas latencias guardadas por clave para los percentiles
+MODULOS_APP = {'bot', '__main__'}
+ORIGENES_IGNORADOS = {'<module>', '<lambda>', 'main', 'polling_con_reintentos', 'ejecutar_tareas_programadas'}
+
+# Backend de almacenamiento (None si no se pudo crear)
+backend = None
+try:
+    backend = backends.crear_backend(STORAGE_BACKEND)
+    if backend.nombre == 'upstash':
+        print("✅ Upstash Redis configurado (la conexión se abre en la primera petición)")
+    else:
+        print(f"⚠️ Almacenamiento local ({backend.nombre}): los datos no se comparten entre réplicas")
+except Exception as e:
+    print(f"⚠️ Error creando el backend de almacenamiento '{STORAGE_BACKEND}': {e}")
+
+# Caché local: {clave: (expira_en, texto_json)} ordenada por uso reciente (LRU)
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# Generación por clave: cada escritura o invalidación la sube. Una lectura del backend solo
+# llena la caché si la generación no cambió mientras leía (si no, podría pisar un valor más
+# nuevo escrito por otro hilo). Al vaciar el diccionario se cambia de época.
+_generaciones = {}
+_epoca = 0
+_siguiente_generacion = 0
+MAX_GENERACIONES = 10000
+
+# Escrituras diferidas pendientes: {clave: (texto_json, limite_monotonic)}
+_pendientes = {}
+_pendientes_lock = threading.Lock()
+_hilo_vaciado = None
+_estadisticas_diferidas = {'coalescidas': 0, 'vaciadas': 0, 'errores': 0}
+
+# Métricas: {familia_clave: {...}} y {handler: {...}}
+_metricas_claves = {}
+_metricas_origenes = {}
+_metricas_lock = threading.Lock()
+
+def redis_disponible():
+    """Verifica si hay backend de almacenamiento disponible"""
+    return backend is not None
+
+def estadisticas_conexiones():
+    """Estadísticas de reutilización de conexiones HTTP del backend (None si no aplica)"""
+    funcion = getattr(backend, 'estadisticas_conexiones', None)
+    return funcion() if funcion else None
+
+def _familia(clave):
+    """Agrupa las claves por usuario/fecha: 'estado:123' -> 'estado:#'"""
+    return re.sub(r'\d+', '#', clave)
+
+def _origen():
+    """Handler o tarea de bot.py que originó la llamada (la función de la app más externa de la pila)"""
+    origen = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_globals.get('__name__') in MODULOS_APP and frame.f_code.co_name not in ORIGENES_IGNORADOS:
+            origen = frame.f_code.co_name
+        frame = frame.f_back
+    return origen or 'otro'
+
+def _tamaño(crudo):
+    """Bytes que ocupa un valor crudo serializado"""
+    if isinstance(crudo, str):
+        return len(crudo.encode('utf-8'))
+    return 0 if crudo is None else len(str(crudo))
+
+def _registrar(operacion, inicio, entradas):
+    """Anota una operación de almacenamiento: llamadas, aciertos de caché, latencia y bytes.
+    entradas: [(clave, bytes, acierto_cache)] de cada clave tocada por la operación"""
+    if not METRICAS_ACTIVAS or not entradas:
+        return
+    duracion = time.perf_counter() - inicio
+    origen = _origen()
+    red = not all(acierto for _, _, acierto in entradas)
+    campo_bytes = 'bytes_leidos' if operacion == 'lectura' else 'bytes_escritos'
+    with _metricas_lock:
+        for clave, bytes_, acierto in entradas:
+            m = _metricas_claves.setdefault(_familia(clave), {
+                'lecturas': 0, 'escrituras': 0, 'aciertos_cache': 0,
+                'bytes_leidos': 0, 'bytes_escritos': 0,
+                'latencias': deque(maxlen=MUESTRAS_LATENCIA)})
+            m['lecturas' if operacion == 'lectura' else 'escrituras'] += 1
+            m[campo_bytes] += bytes_
+            if acierto:
+                m['aciertos_cache'] += 1
+            else:
+                m['latencias'].append(duracion)
+        o = _metricas_origenes.setdefault(origen, {'llamadas': 0, 'peticiones_red': 0, 'segundos': 0.0, 'bytes': 0})
+        o['llamadas'] += 1
+        o['peticiones_red'] += 1 if red else 0
+        o['segundos'] += duracion
+        o['bytes'] += sum(bytes_ for _, bytes_, _ in entradas)
+
+def percentil(valores, p):
+    """Percentil p (0-100) de una lista ya ordenada"""
+    if not valores:
+        return 0.0
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+def metricas():
+    """Resumen de métricas: {'claves': {familia: {...}}, 'origenes': {handler: {...}}}"""
+    with _metricas_lock:
+        claves = {}
+        for familia, m in _metricas_claves.items():
+            latencias = sorted(m['latencias'])
+            claves[familia] = {k: v for k, v in m.items() if k != 'latencias'}
+            claves[familia].update({
+                'p50_ms': percentil(latencias, 50) * 1000,
+                'p95_ms': percentil(latencias, 95) * 1000,
+                'p99_ms': percentil(latencias, 99) * 1000,
+            })
+        origenes = {o: dict(m) for o, m in _metricas_origenes.items()}
+    with _pendientes_lock:
+        diferidas = dict(_estadisticas_diferidas, pendientes=len(_pendientes))
+    return {'claves': claves, 'origenes': origenes, 'conexiones': estadisticas_conexiones(),
+            'diferidas': diferidas}
+
+def metricas_prometheus():
+    """Métricas en formato de texto de Prometheus (para el endpoint /metrics)"""
+    datos = metricas()
+    lineas = []
+    for familia, m in sorted(datos['claves'].items()):
+        etiqueta = f'clave="{familia}"'
+        lineas.append(f'perla_storage_lecturas_total{{{etiqueta}}} {m["lecturas"]}')
+        lineas.append(f'perla_storage_escrituras_total{{{etiqueta}}} {m["escrituras"]}')
+        lineas.append(f'perla_storage_aciertos_cache_total{{{etiqueta}}} {m["aciertos_cache"]}')
+        lineas.append(f'perla_storage_bytes_leidos_total{{{etiqueta}}} {m["bytes_leidos"]}')
+        lineas.append(f'perla_storage_bytes_escritos_total{{{etiqueta}}} {m["bytes_escritos"]}')
+        for cuantil, campo in (('0.5', 'p50_ms'), ('0.95', 'p95_ms'), ('0.99', 'p99_ms')):
+            lineas.append(f'perla_storage_latencia_segundos{{{etiqueta},quantile="{cuantil}"}} {m[campo] / 1000:.6f}')
+    for origen, m in sorted(datos['origenes'].items()):
+        etiqueta = f'handler="{origen}"'
+        lineas.append(f'perla_storage_llamadas_total{{{etiqueta}}} {m["llamadas"]}')
+        lineas.append(f'perla_storage_peticiones_red_total{{{etiqueta}}} {m["peticiones_red"]}')
+        lineas.append(f'perla_storage_segundos_total{{{etiqueta}}} {m["segundos"]:.6f}')
+        lineas.append(f'perla_storage_bytes_total{{{etiqueta}}} {m["bytes"]}')
+    for campo, valor in datos['diferidas'].items():
+        lineas.append(f'perla_storage_diferidas_{campo} {valor}')
+    if datos['conexiones']:
+        for campo, valor in datos['conexiones'].items():
+            lineas.append(f'perla_storage_conexiones_{campo} {valor}')
+    return '\n'.join(lineas) + '\n'
+
+def _decodificar(valor):
+    """Convierte el texto JSON (ya descomprimido) en un objeto Python"""
+    return codec.deserializar(valor) if isinstance(valor, str) else valor
+
+def _cache_leer(clave):
+    """Devuelve (encontrado, texto_json) desde las escrituras pendientes o la caché local"""
+    if _pendientes:
+        with _pendientes_lock:
+            pendiente = _pendientes.get(clave)
+        if pendiente is not None:
+            return True, pendiente[0]
+    if CACHE_TTL <= 0:
+        return False, None
+    with _cache_lock:
+        entrada = _cache.get(clave)
+        if entrada is None:
+            return False, None
+        expira_en, crudo = entrada
+        if expira_en < time.monotonic():
+            del _cache[clave]
+            return False, None
+        _cache.move_to_end(clave)
+        return True, crudo
+
+def _nueva_generacion(clave):
+    """Marca que la clave ha cambiado (llamar con _cache_lock tomado)"""
+    global _siguiente_generacion, _epoca
+    if len(_generaciones) >= MAX_GENERACIONES:
+        _generaciones.clear()
+        _epoca += 1
+    _siguiente_generacion += 1
+    _generaciones[clave] = _siguiente_generacion
+
+def _generacion(clave):
+    """Generación actual de la clave (capturar antes de leer del backend)"""
+    with _cache_lock:
+        return _epoca, _generaciones.get(clave, 0)
+
+def _cache_escribir(clave, texto, generacion=None):
+    """Guarda un texto JSON en la caché local, expulsando el menos usado si está llena.
+    Sin generación es una escritura (write-through); con la generación capturada antes de leer
+    del backend es un relleno, que se descarta si la clave cambió mientras tanto."""
+    with _cache_lock:
+        if generacion is None:
+            _nueva_generacion(clave)
+        elif generacion != (_epoca, _generaciones.get(clave, 0)):
+            return
+        if CACHE_TTL <= 0:
+            return
+        _cache[clave] = (time.monotonic() + CACHE_TTL, texto)
+        _cache.move_to_end(clave)
+        while len(_cache) > CACHE_MAX_CLAVES:
+            _cache.popitem(last=False)
+
+def invalidar(clave=None):
+    """Elimina una clave de la caché local (o toda la caché si no se indica clave)"""
+    global _epoca
+    with _cache_lock:
+        if clave is None:
+            _cache.clear()
+            _generaciones.clear()
+            _epoca += 1
+        else:
+            _cache.pop(clave, None)
+            _nueva_generacion(clave)
+
+def segundos_diferido(clave):
+    """Plazo de escritura diferida de una clave (None si se escribe al momento)"""
+    if not CLAVES_DIFERIDAS:
+        return None
+    segundos = CLAVES_DIFERIDAS.get(clave)
+    return segundos if segundos is not None else CLAVES_DIFERIDAS.get(_familia(clave))
+
+def _diferir(clave, texto, segundos):
+    """Deja una escritura en memoria; si ya había una pendiente se sustituye y conserva su plazo"""
+    global _hilo_vaciado
+    with _pendientes_lock:
+        anterior = _pendientes.get(clave)
+        if anterior is not None:
+            _estadisticas_diferidas['coalescidas'] += 1
+            limite = anterior[1]
+        else:
+            limite = time.monotonic() + segundos
+        _pendientes[clave] = (texto, limite)
+        if _hilo_vaciado is None:
+            _hilo_vaciado = threading.Thread(target=_bucle_vaciado, daemon=True)
+            _hilo_vaciado.start()
+    _cache_escribir(clave, texto)
+
+def _bucle_vaciado():
+    """Hilo que escribe cada segundo las claves diferidas cuyo plazo ha vencido"""
+    while True:
+        time.sleep(1)
+        vaciar_pendientes(solo_vencidas=True)
+
+def vaciar_pendientes(solo_vencidas=False):
+    """Escribe en el backend las claves diferidas (todas, o solo las vencidas). Devuelve cuántas"""
+    if not backend:
+        return 0
+    ahora = time.monotonic()
+    with _pendientes_lock:
+        lote = {c: t for c, (t, limite) in _pendientes.items() if not solo_vencidas or limite <= ahora}
+    if not lote:
+        return 0
     try:
-        redis_client = Redis(url=REDIS_URL, token=REDIS_TOKEN)
-        print("✅ Conectado a Upstash Redis")
+        inicio = time.perf_counter()
+        crudos = {c: codec.comprimir(t) for c, t in lote.items()}
+        backend.mset(crudos)
+        _registrar('escritura', inicio, [(c, _tamaño(t), False) for c, t in crudos.items()])
     except Exception as e:
-        print(f"⚠️ Error conectando a Redis: {e}")
+        # Se quedan en la cola y se reintentan en la siguiente pasada
+        print(f"Error vaciando {len(lote)} escrituras diferidas: {e}")
+        with _pendientes_lock:
+            _estadisticas_diferidas['errores'] += 1
+        return 0
+    with _pendientes_lock:
+        for clave, texto in lote.items():
+            # Si llegó una escritura más nueva mientras tanto, se queda para la siguiente pasada
+            if _pendientes.get(clave, (None,))[0] is texto:
+                del _pendientes[clave]
+        _estadisticas_diferidas['vaciadas'] += len(lote)
+    return len(lote)
 
-def redis_disponible():
-    """Verifica si Redis está disponible"""
-    return redis_client is not None
+# Al salir del proceso no se pierde nada de lo que estaba pendiente
+atexit.register(vaciar_pendientes)
 
 def obtener(clave, default=None):
-    """Obtiene un valor de Redis"""
-    if not redis_client:
+    """Obtiene un valor de Redis (pasando primero por la caché local)"""
+    if not backend:
         return default
+    inicio = time.perf_counter()
+    encontrado, valor = _cache_leer(clave)
+    bytes_ = 0
     try:
-        valor = redis_client.get(clave)
-        if valor is None:
-            return default
-        return json.loads(valor) if isinstance(valor, str) else valor
+        if not encontrado:
+            generacion = _generacion(clave)
+            crudo = backend.get(clave)
+            bytes_ = _tamaño(crudo)
+            valor = codec.descomprimir(crudo)
+            # También se cachean las claves inexistentes para no repetir la consulta
+            _cache_escribir(clave, valor, generacion)
+    except Exception as e:
+        print(f"Error leyendo {clave}: {e}")
+        return default
+    _registrar('lectura', inicio, [(clave, bytes_, encontrado)])
+    if valor is None:
+        return default
+    try:
+        return _decodificar(valor)
     except Exception as e:
         print(f"Error leyendo {clave}: {e}")
+        invalidar(clave)
         return default
 
 def guardar(clave, valor):
-    """Guarda un valor en Redis"""
-    if not redis_client:
+    """Guarda un valor en Redis (write-through: la caché queda actualizada).
+    Las claves configuradas en STORAGE_DIFERIDO se escriben más tarde en bloque."""
+    if not backend:
         return False
     try:
-        redis_client.set(clave, json.dumps(valor, ensure_ascii=False))
+        inicio = time.perf_counter()
+        texto = codec.serializar(valor)
+        segundos = segundos_diferido(clave)
+        if segundos is not None:
+            _diferir(clave, texto, segundos)
+            return True
+        crudo = codec.comprimir(texto)
+        backend.set(clave, crudo)
+        _cache_escribir(clave, texto)
+        _registrar('escritura', inicio, [(clave, _tamaño(crudo), False)])
         return True
     except Exception as e:
         print(f"Error guardando {clave}: {e}")
+        invalidar(clave)
+        return False
+
+def obtener_muchos(claves, default=None, cachear=True, marcar_fallos=False):
+    """Obtiene varias claves con una sola petición MGET (por lotes). Devuelve {clave: valor}.
+    Con cachear=False no se llena la caché local (útil para barridos de miles de claves).
+    Con marcar_fallos=True, las claves de un lote que falló valen FALLO_LECTURA en vez de default."""
+    claves = list(dict.fromkeys(claves))
+    inicio = time.perf_counter()
+    textos = {}
+    bytes_leidos = {}
+    fallidas = set()
+    faltan = []
+    for clave in claves:
+        encontrado, valor = _cache_leer(clave)
+        if encontrado:
+            textos[clave] = valor
+        else:
+            faltan.append(clave)
+
+    if faltan and backend:
+        for i in range(0, len(faltan), LOTE_MAX):
+            lote = faltan[i:i + LOTE_MAX]
+            generaciones = {clave: _generacion(clave) for clave in lote} if cachear else {}
+            try:
+                valores = backend.mget(*lote)
+            except Exception as e:
+                print(f"Error leyendo {len(lote)} claves ({lote[0]}...): {e}")
+                fallidas.update(lote)
+                continue
+            for clave, crudo in zip(lote, valores):
+                bytes_leidos[clave] = _tamaño(crudo)
+                try:
+                    textos[clave] = codec.descomprimir(crudo)
+                except Exception as e:
+                    print(f"Error leyendo {clave}: {e}")
+                    continue
+                if cachear:
+                    _cache_escribir(clave, textos[clave], generaciones[clave])
+    pendientes = set(faltan)
+    _registrar('lectura', inicio, [(c, bytes_leidos.get(c, 0), c not in pendientes) for c in claves])
+
+    resultado = {}
+    for clave in claves:
+        valor = textos.get(clave)
+        if marcar_fallos and clave in fallidas:
+            resultado[clave] = FALLO_LECTURA
+            continue
+        if valor is None:
+            resultado[clave] = default
+            continue
+        try:
+            resultado[clave] = _decodificar(valor)
+        except Exception as e:
+            print(f"Error leyendo {clave}: {e}")
+            invalidar(clave)
+            resultado[clave] = default
+    return resultado
+
+def guardar_muchos(valores, cachear=True):
+    """Guarda varias claves con peticiones MSET por lotes ({clave: valor}).
+    Con cachear=False no se llena la caché local (se invalida lo que hubiera)."""
+    if not backend or not valores:
+        return False
+    try:
+        inicio = time.perf_counter()
+        textos = {}
+        for clave, valor in valores.items():
+            texto = codec.serializar(valor)
+            segundos = segundos_diferido(clave)
+            if segundos is not None:
+                _diferir(clave, texto, segundos)
+            else:
+                textos[clave] = texto
+        if not textos:
+            return True
+        crudos = {clave: codec.comprimir(texto) for clave, texto in textos.items()}
+        claves = list(crudos)
+        for i in range(0, len(claves), LOTE_MAX):
+            backend.mset({clave: crudos[clave] for clave in claves[i:i + LOTE_MAX]})
+        for clave, texto in textos.items():
+            if cachear:
+                _cache_escribir(clave, texto)
+            else:
+                invalidar(clave)
+        _registrar('escritura', inicio, [(c, _tamaño(t), False) for c, t in crudos.items()])
+        return True
+    except Exception as e:
+        print(f"Error guardando {len(valores)} claves ({next(iter(valores))}...): {e}")
+        for clave in valores:
+            invalidar(clave)
+        return False
+
+def incrementar(clave, expira_en=None):
+    """Incrementa un contador de forma atómica en Redis (INCR) y devuelve el nuevo valor (0 si falla).
+    expira_en: timestamp unix en el que Redis borrará la clave; INCR y EXPIREAT van en la misma
+    transacción, así que nunca queda un contador sin caducidad ni un incremento sin confirmar"""
+    if not backend:
+        return 0
+    try:
+        inicio = time.perf_counter()
+        if expira_en:
+            valor = backend.incr_expireat(clave, int(expira_en))
+        else:
+            valor = backend.incr(clave)
+        _cache_escribir(clave, str(valor))
+        _registrar('escritura', inicio, [(clave, 0, False)])
+        return valor
+    except Exception as e:
+        print(f"Error incrementando {clave}: {e}")
+        invalidar(clave)
+        return 0
+
+def borrar(clave):
+    """Elimina una clave de Redis. Devuelve True si existía"""
+    if not backend:
+        return False
+    try:
+        inicio = time.perf_counter()
+        with _pendientes_lock:
+            _pendientes.pop(clave, None)
+        existia = backend.delete(clave)
+        _cache_escribir(clave, None)
+        _registrar('escritura', inicio, [(clave, 0, False)])
+        return bool(existia)
+    except Exception as e:
+        print(f"Error borrando {clave}: {e}")
+        invalidar(clave)
         return False
 
 def obtener_lista(clave):